@@ -0,0 +1,285 @@
+import contextlib
+import getopt
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import poker
+
+BASELINE_FILE = "benchmark_baseline.json"
+
+def random_hands(num_hands, num_cards, seed = 0):
+    #
+    # num_hands lists of num_cards cards, each dealt from its own deck
+    #
+    rng = random.Random(seed)
+    hands = []
+    for i in range(num_hands):
+        deck = poker.get_deck()
+        hands.append([poker.deal(deck, rng) for j in range(num_cards)])
+    return hands
+
+def random_tables(num_tables, num_hands, num_cards, seed = 0):
+    #
+    # num_tables showdowns of num_hands hands dealt from one deck
+    #
+    rng = random.Random(seed)
+    tables = []
+    for i in range(num_tables):
+        deck = poker.get_deck()
+        tables.append([[poker.deal(deck, rng) for k in range(num_cards)] for j in range(num_hands)])
+    return tables
+
+def straight_rank(hand):
+    values = sorted([poker.get_value(card) for card in hand])
+    if values == [2, 3, 4, 5, poker.ACE]:
+        return 5
+    return max(values)
+
+def reference_key(hand):
+    #
+    # Brute force sort key for a 5 card hand, built from the original rank
+    # predicates and value counts rather than the lookup tables
+    #
+    if poker.is_straight_flush(hand):
+        rank = poker.STRAIGHT_FLUSH
+    elif poker.is_four_of_a_kind(hand):
+        rank = poker.FOUR_OF_A_KIND
+    elif poker.is_full_house(hand):
+        rank = poker.FULL_HOUSE
+    elif poker.is_flush(hand):
+        rank = poker.FLUSH
+    elif poker.is_straight(hand):
+        rank = poker.STRAIGHT
+    elif poker.has_set(hand):
+        rank = poker.SET
+    elif poker.has_two_pair(hand):
+        rank = poker.TWO_PAIRS
+    elif poker.has_pair(hand):
+        rank = poker.PAIR
+    else:
+        rank = poker.HIGH_CARD
+
+    if rank in (poker.STRAIGHT_FLUSH, poker.STRAIGHT):
+        return (rank, [straight_rank(hand)])
+    values = [poker.get_value(card) for card in hand]
+    return (rank, sorted(values, key=lambda value: (values.count(value), value), reverse=True))
+
+def reference_winners(hands):
+    keys = [reference_key(hand) for hand in hands]
+    best = max(keys)
+    return [hand for hand, key in zip(hands, keys) if key == best]
+
+def reference_best_key(cards):
+    return max([reference_key(list(hand)) for hand in itertools.combinations(cards, 5)])
+
+def reference_omaha_strength(hole, field):
+    #
+    # Best hand using exactly 2 hole cards and 3 field cards, by scoring
+    # every combination
+    #
+    return max([poker.hand_strength(list(pair) + list(triple))
+        for pair in itertools.combinations(hole, 2) for triple in itertools.combinations(field, 3)])
+
+def cross_check(num_hands = 20000):
+    #
+    # Compare the evaluators against the brute force reference. Returns a list
+    # of failure descriptions, empty when everything agrees.
+    #
+    failures = []
+
+    for hand in random_hands(num_hands, 5, seed=1):
+        if poker.hand_rank(hand) != reference_key(hand)[0]:
+            failures.append("hand_rank %s" % poker.format_hand(hand))
+
+    for num_players in range(2, 11):
+        for hands in random_tables(num_hands // 20, num_players, 5, seed=num_players):
+            if poker.get_winners(hands) != reference_winners(hands):
+                failures.append("get_winners %s" % " | ".join([poker.format_hand(hand) for hand in hands]))
+
+    #
+    # Best hand out of 6 and 7 cards: strengths must order like the reference
+    # keys, and the 5 cards handed back must be a best hand
+    #
+    for num_cards in (6, 7):
+        hands = random_hands(num_hands // 20, num_cards, seed=num_cards)
+        strengths = [poker.best_hand_strength(cards) for cards in hands]
+        keys = [reference_best_key(cards) for cards in hands]
+        for i in range(1, len(hands)):
+            if (strengths[i] > strengths[i - 1]) != (keys[i] > keys[i - 1]) or \
+                    (strengths[i] == strengths[i - 1]) != (keys[i] == keys[i - 1]):
+                failures.append("best_hand_strength %s vs %s" % (poker.format_hand(hands[i]), poker.format_hand(hands[i - 1])))
+        for cards, key in zip(hands, keys):
+            best = poker.get_best_holdem_hand(cards[:2], cards[2:])
+            if reference_key(list(best)) != key:
+                failures.append("get_best_holdem_hand %s" % poker.format_hand(cards))
+        if list(poker.batch_strengths(np.array(hands))) != strengths:
+            failures.append("batch_strengths on %d cards" % num_cards)
+
+    #
+    # Omaha, for each hole and field size: the pruned evaluator one hand at a
+    # time, and the batch one over tables of 3
+    #
+    for num_hole in (4, 5):
+        for field_size in (3, 4, 5):
+            for cards in random_hands(num_hands // 40, num_hole + field_size, seed=num_hole * 10 + field_size):
+                if poker.best_omaha_strength(cards[:num_hole], cards[num_hole:]) != \
+                        reference_omaha_strength(cards[:num_hole], cards[num_hole:]):
+                    failures.append("best_omaha_strength %s | %s" % (poker.format_hand(cards[:num_hole]),
+                        poker.format_hand(cards[num_hole:])))
+            tables = np.array(random_hands(num_hands // 40, 3 * num_hole + field_size, seed=num_hole * 10 + field_size))
+            holes = tables[:, :3 * num_hole].reshape(len(tables), 3, num_hole)
+            field = tables[:, 3 * num_hole:]
+            reference = [[reference_omaha_strength(hole, row_field) for hole in row_holes]
+                for row_holes, row_field in zip(holes.tolist(), field.tolist())]
+            if poker.omaha_batch_strengths(holes, field).tolist() != reference:
+                failures.append("omaha_batch_strengths with %d hole and %d field cards" % (num_hole, field_size))
+
+    return failures
+
+def time_call(fn, min_seconds = 0.5):
+    #
+    # Returns seconds per call, calling fn until min_seconds have gone by.
+    # The first call warms up lazily built tables and isn't counted.
+    #
+    fn()
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_seconds:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / calls
+
+def get_benchmarks(quick = False):
+    #
+    # (name, function, hands evaluated per call)
+    #
+    five_card = random_hands(1000, 5)
+    seven_card = random_hands(1000, 7)
+    aces = [poker.make_card(poker.ACE, poker.DIAMONDS), poker.make_card(poker.ACE, poker.HEARTS)]
+    sweep_runs = 5 if quick else 20
+
+    benchmarks = [
+        ("hand_rank", lambda: [poker.hand_rank(hand) for hand in five_card], len(five_card)),
+        ("best_hand_strength", lambda: [poker.best_hand_strength(cards) for cards in seven_card], len(seven_card)),
+        ("get_best_holdem_hand", lambda: [poker.get_best_holdem_hand(cards[:2], cards[2:]) for cards in seven_card[:100]], 100),
+        ("batch_strengths", lambda: poker.batch_strengths(np.array(seven_card)), len(seven_card)),
+    ]
+    for num_players in (2, 6, 10):
+        tables = random_tables(100, num_players, 5)
+        benchmarks.append(("get_winners_%d" % num_players,
+            lambda tables=tables: [poker.get_winners(hands) for hands in tables], len(tables) * num_players))
+    benchmarks += [
+        ("run_hold_em_hand", lambda: [poker.run_hold_em_hand(5, aces) for i in range(100)], 600),
+        ("run_hold_em_batch", lambda: poker.run_hold_em_batch(10000, 6, aces, False, 10000), 60000),
+        ("run_hold_em_streets_batch", lambda: poker.run_hold_em_streets_batch(10000, 6, aces, 10000), 60000),
+        ("run_hold_em_sizes_batch", lambda: poker.run_hold_em_sizes_batch(10000, 10, aces, False, 10000), 100000),
+        ("run_five_card_sim", lambda: poker.run_five_card_sim(100, 6), 600),
+        ("run_five_card_batch", lambda: poker.run_five_card_batch(10000, 6, 10000), 60000),
+        ("run_omaha_chunk", lambda: poker.run_omaha_chunk((0, 10000, 6, 4, False, 2000, 0)), 60000),
+        ("run_hold_em_sim", lambda: poker.run_hold_em_sim(sweep_runs, 3, False, seed=0), 169 * sweep_runs * 3),
+    ]
+    return benchmarks
+
+def run_benchmarks(quick = False):
+    results = {}
+    random.seed(0)
+    for name, fn, num_hands in get_benchmarks(quick):
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = time_call(fn, 0.2 if quick else 1.0)
+        results[name] = {"latency_us": seconds * 1e6, "hands_per_sec": num_hands / seconds}
+        print("%-24s %12.1f us/call %14.0f hands/sec" % (name, seconds * 1e6, num_hands / seconds))
+    return results
+
+def compare(results, baseline, tolerance):
+    #
+    # Names of benchmarks that got more than tolerance slower than the baseline
+    #
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["hands_per_sec"]
+        if result["hands_per_sec"] < before * (1.0 - tolerance):
+            regressions.append("%s: %.0f hands/sec, baseline %.0f" % (name, result["hands_per_sec"], before))
+    return regressions
+
+def usage():
+    msg = """
+%s [options]
+Parameters
+----------
+--baseline=[file] baseline file to compare against or save to. Defaults to
+       %s
+--save Save these results as the new baseline instead of comparing.
+--tolerance=[fraction] how much slower than the baseline a benchmark can get
+       before it counts as a regression. Defaults to 0.2
+--quick Shorter timings and a smaller sweep.
+--skip-check Don't cross check the evaluators against the brute force
+       reference first.
+    """ % (sys.argv[0], BASELINE_FILE)
+    print(msg)
+
+if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["baseline=", "save", "tolerance=", "quick", "skip-check", "help"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        exit(1)
+
+    baseline_file = BASELINE_FILE
+    save = False
+    tolerance = 0.2
+    quick = False
+    check = True
+    for o, a in opts:
+        if o == "--baseline":
+            baseline_file = a
+        elif o == "--save":
+            save = True
+        elif o == "--tolerance":
+            tolerance = float(a)
+        elif o == "--quick":
+            quick = True
+        elif o == "--skip-check":
+            check = False
+        else:
+            usage()
+            exit(0)
+
+    if check:
+        failures = cross_check(5000 if quick else 20000)
+        if failures:
+            print("%d evaluator mismatches against the reference:" % len(failures))
+            for failure in failures[:20]:
+                print("\t%s" % failure)
+            exit(1)
+        print("evaluators match the brute force reference")
+
+    results = run_benchmarks(quick)
+
+    if save:
+        with open(baseline_file, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print("wrote %s" % baseline_file)
+    elif os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance)
+        if regressions:
+            print("regressions against %s:" % baseline_file)
+            for regression in regressions:
+                print("\t%s" % regression)
+            exit(1)
+        print("no regressions against %s" % baseline_file)
+    else:
+        print("no baseline in %s, run with --save to make one" % baseline_file)
@@ -1,13 +1,30 @@
 import copy
+import collections
 import random
 import itertools
 import getopt
 import sys
-import matplotlib.pyplot as plt
+import os
+import multiprocessing
+import time
+import cProfile
+import re
+import asyncio
 import numpy as np
 import csv
+import json
+import math
+import contextlib
+import tracemalloc
 
 debug = False
+verbose = False
+
+#
+# Per stage timers and counters (see new_stats), only collected when this is
+# set, so the simulations pay nothing for them otherwise
+#
+stage_stats = None
 
 JACK = 11
 QUEEN = 12
@@ -32,21 +49,76 @@ suits = [DIAMONDS, HEARTS, CLUBS, SPADES]
 
 card_values = [2, 3, 4, 5, 6, 7, 8, 9, 10, JACK, QUEEN, KING, ACE]
 
+#
+# Internally a card is an int from 0 to 51, (value - 2) * 4 + suit index. The
+# (value, suit) tuple form is only used when reading and formatting hands.
+#
+NUM_CARDS = 52
+
+def make_card(value, suit):
+    return (value - 2) * 4 + suits.index(suit)
+
+def card_tuple(card):
+    return (get_value(card), get_suit(card))
+
+full_deck = list(range(NUM_CARDS))
+
 def get_deck():
-    deck = []
-    for card in card_values:
-        for suit in suits:
-            deck.append((card, suit))
-    return deck
-
-def deal(deck):
-    card = random.randrange(len(deck))
+    return full_deck[:]
+
+def deal(deck, rng = random):
+    #
+    # Order doesn't matter in the deck, so fill the hole with the last card
+    # rather than shifting everything down
+    #
+    card = rng.randrange(len(deck))
     ret = deck[card]
-    del deck[card]
+    deck[card] = deck[-1]
+    deck.pop()
     return ret
 
+DEAL_BUFFER = 4096
+
+def new_dealer(exclude = (), rng = None):
+    #
+    # A deck to deal from again and again, less the cards in exclude. rng is a
+    # NumPy Generator, which random numbers are pulled from DEAL_BUFFER at a
+    # time, or anything with random() like the random module.
+    #
+    if rng is None:
+        rng = np.random.default_rng()
+    deck = full_deck[:]
+    for card in exclude:
+        deck.remove(card)
+    return {"deck": deck, "rng": rng, "randoms": [], "next": 0}
+
+def deal_cards(dealer, num_cards):
+    #
+    # Partial Fisher-Yates shuffle: only the first num_cards places of the
+    # deck are shuffled, and they are the cards dealt. The deck is left in
+    # whatever order that gives, which is as good a start as any for the next
+    # deal.
+    #
+    deck = dealer["deck"]
+    size = len(deck)
+    randoms = dealer["randoms"]
+    position = dealer["next"]
+    if position + num_cards > len(randoms):
+        rng = dealer["rng"]
+        if isinstance(rng, np.random.Generator):
+            randoms = rng.random(max(DEAL_BUFFER, num_cards)).tolist()
+        else:
+            randoms = [rng.random() for i in range(num_cards)]
+        dealer["randoms"] = randoms
+        position = 0
+    for i in range(num_cards):
+        j = i + int(randoms[position + i] * (size - i))
+        deck[i], deck[j] = deck[j], deck[i]
+    dealer["next"] = position + num_cards
+    return deck[:num_cards]
+
 def format_card(card):
-    value, suit = card
+    value, suit = card_tuple(card)
     if value == JACK:
         value = 'J'
     elif value == QUEEN:
@@ -65,7 +137,7 @@ def format_holdem_hand_for_graph(hand):
     values = []
     
     for card in hand:
-        value, suit = card
+        value = get_value(card)
         if value == JACK:
             values.append('J')
         elif value == QUEEN:
@@ -77,7 +149,7 @@ def format_holdem_hand_for_graph(hand):
         else:
             values.append(str(value))
     ret = ','.join(values)
-    if hand[0][1] == hand[1][1]:
+    if get_suit(hand[0]) == get_suit(hand[1]):
         ret +='s'        
     return ret
 
@@ -109,10 +181,10 @@ def format_rank(rank):
     return ret
 
 def get_suit(card):
-    return card[1]
+    return suits[card & 3]
 
 def get_value(card):
-    return card[0]
+    return (card >> 2) + 2
 
 def is_flush(hand):
     suit = None
@@ -179,11 +251,6 @@ def has_set(hand):
 def has_pair(hand):
     return has_num_cards(hand, 2)
 
-def has_pair_of(hand, value):
-    if [get_value(card) for card in hand].count(value) == 2:
-        return True
-    return False   
-
 def has_two_pair(hand):
     ret = False
     pair = has_num_cards_ranking(hand, 2)
@@ -213,168 +280,1198 @@ def card_count(values, value):
     return count
 
 def hand_rank(hand):
-    if is_straight_flush(hand):
-        rank = STRAIGHT_FLUSH
-    elif is_four_of_a_kind(hand):
-        rank = FOUR_OF_A_KIND
-    elif is_full_house(hand):
-        rank = FULL_HOUSE
-    elif is_flush(hand):
-        rank = FLUSH
-    elif is_straight(hand):
-        rank = STRAIGHT
-    elif has_set(hand):
-        rank = SET
-    elif has_two_pair(hand):
-        rank = TWO_PAIRS
-    elif has_pair(hand):
-        rank = PAIR
-    else:
-        rank = HIGH_CARD
-    return rank
+    return strength_rank(hand_strength(hand))
 
-def straight_rank(hand):
-    values = [get_value(card) for card in hand]
-    values.sort()
+def strength_rank(strength):
+    return strength >> STRENGTH_SHIFT
 
-    if values == [2, 3, 4, 5, ACE]:
-        ret = 5
-    else:
-        ret = max(values)
+#
+# Hand strengths are single integers, higher is always better. The rank
+# (STRAIGHT_FLUSH ... HIGH_CARD) sits above five 4-bit slots holding the values
+# that break ties inside the rank, most significant first.
+#
+STRENGTH_SHIFT = 20
+
+primes = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41]
+
+def make_strength(rank, values):
+    ret = rank
+    for i in range(5):
+        ret = (ret << 4) | (values[i] if i < len(values) else 0)
     return ret
 
-def get_kickers(hand):
-    kickers = []
-    set_value = has_num_cards_ranking(hand, 3)
-    if set_value:
-        for card in hand:
-            value = get_value(card)
-            if value != set_value:
-                kickers.append(value)
-    else:
-        pair_value = has_num_cards_ranking(hand, 2)
-        if pair_value:
-            for card in hand:
-                value = get_value(card)
-                if value != pair_value:
-                    kickers.append(value)
+def score_values(values, flush):
+    #
+    # Score five card values directly. Only used to build the lookup tables.
+    #
+    groups = sorted([(values.count(value), value) for value in set(values)], reverse=True)
+    counts = [group[0] for group in groups]
+    ordered = [group[1] for group in groups]
+
+    straight = None
+    if len(ordered) == 5:
+        if ordered == [ACE, 5, 4, 3, 2]:
+            straight = 5
+        elif ordered[0] - ordered[4] == 4:
+            straight = ordered[0]
+
+    if straight and flush:
+        return make_strength(STRAIGHT_FLUSH, [straight])
+    elif counts[0] == 4:
+        return make_strength(FOUR_OF_A_KIND, ordered)
+    elif counts == [3, 2]:
+        return make_strength(FULL_HOUSE, ordered)
+    elif flush:
+        return make_strength(FLUSH, ordered)
+    elif straight:
+        return make_strength(STRAIGHT, [straight])
+    elif counts[0] == 3:
+        return make_strength(SET, ordered)
+    elif counts[:2] == [2, 2]:
+        return make_strength(TWO_PAIRS, ordered)
+    elif counts[0] == 2:
+        return make_strength(PAIR, ordered)
+    return make_strength(HIGH_CARD, ordered)
+
+def build_tables():
+    #
+    # Five distinct values are looked up by their value bitmask, once for
+    # flushes and once for everything else. Hands with repeated values can't
+    # be flushes and are looked up by the product of one prime per value,
+    # which is unique to the multiset of values.
+    #
+    flush_table = [0] * (1 << (ACE + 1))
+    unique_table = [0] * (1 << (ACE + 1))
+    product_table = {}
+    for values in itertools.combinations_with_replacement(card_values, 5):
+        values = list(values)
+        if len(set(values)) == 5:
+            mask = 0
+            for value in values:
+                mask |= 1 << value
+            flush_table[mask] = score_values(values, True)
+            unique_table[mask] = score_values(values, False)
+        elif max([values.count(value) for value in values]) <= 4:
+            product = 1
+            for value in values:
+                product *= primes[value - 2]
+            product_table[product] = score_values(values, False)
+    return flush_table, unique_table, product_table
+
+flush_table, unique_table, product_table = build_tables()
+
+#
+# Per card value bit and prime, so the evaluators don't decode cards
+#
+card_bits = [1 << get_value(card) for card in full_deck]
+card_primes = [primes[card >> 2] for card in full_deck]
+
+def hand_strength(hand):
+    mask = 0
+    product = 1
+    suit = hand[0] & 3
+    flush = True
+    for card in hand:
+        mask |= card_bits[card]
+        product *= card_primes[card]
+        if card & 3 != suit:
+            flush = False
+    if flush:
+        return flush_table[mask]
+    elif product in product_table:
+        return product_table[product]
+    return unique_table[mask]
+
+#
+# Lookup tables for scoring from value bitmasks, indexed by mask. straight_table
+# holds the high card of the best straight in the mask (0 for none), and
+# kicker_tables[n] holds the n highest values in the mask packed into 4-bit slots.
+#
+def build_mask_tables():
+    straight_table = [0] * (1 << (ACE + 1))
+    kicker_tables = [[0] * (1 << (ACE + 1)) for n in range(6)]
+    wheel = (1 << ACE) | 0x3c
+    for mask in range(1, 1 << (ACE + 1)):
+        #
+        # Build each mask from the one without its highest value
+        #
+        high = mask.bit_length() - 1
+        rest = mask ^ (1 << high)
+        for n in range(1, 6):
+            kicker_tables[n][mask] = (high << (4 * (n - 1))) | kicker_tables[n - 1][rest]
+
+        run = 0x1f << (high - 4) if high >= 6 else 0
+        if run and mask & run == run:
+            straight_table[mask] = high
+        elif mask & wheel == wheel:
+            straight_table[mask] = max(straight_table[rest], 5)
         else:
-            kickers = [get_value(card) for card in hand]
-    return sorted(kickers, reverse=True)
+            straight_table[mask] = straight_table[rest]
+    return straight_table, kicker_tables
 
-def get_winners(hands):
-    hand_rankings = sorted([(hand_rank(hand), hand) for hand in hands], reverse = True)
-    max_ranking = hand_rankings[0][0]
-    winners = []
+straight_table, kicker_tables = build_mask_tables()
 
-    for rank, hand in hand_rankings:
-        if rank == max_ranking:
-            winners.append(hand)
+def score_masks(mask, pairs, trips, quads, flush_mask):
+    #
+    # mask holds every value present, pairs/trips/quads the values held at
+    # least two/three/four times, flush_mask the values of the flush suit
+    # (0 without a flush).
+    #
+    if flush_mask:
+        high = straight_table[flush_mask]
+        if high:
+            return (STRAIGHT_FLUSH << STRENGTH_SHIFT) | (high << 16)
+    if quads:
+        quad = quads.bit_length() - 1
+        return (FOUR_OF_A_KIND << STRENGTH_SHIFT) | (quad << 16) | (kicker_tables[1][mask ^ (1 << quad)] << 12)
+    if trips:
+        trip = trips.bit_length() - 1
+        rest = pairs ^ (1 << trip)
+        if rest:
+            return (FULL_HOUSE << STRENGTH_SHIFT) | (trip << 16) | ((rest.bit_length() - 1) << 12)
+    if flush_mask:
+        return (FLUSH << STRENGTH_SHIFT) | kicker_tables[5][flush_mask]
+    high = straight_table[mask]
+    if high:
+        return (STRAIGHT << STRENGTH_SHIFT) | (high << 16)
+    if trips:
+        return (SET << STRENGTH_SHIFT) | (trip << 16) | (kicker_tables[2][mask ^ (1 << trip)] << 8)
+    if pairs:
+        pair = pairs.bit_length() - 1
+        rest = pairs ^ (1 << pair)
+        if rest:
+            low_pair = rest.bit_length() - 1
+            kickers = kicker_tables[1][mask ^ (1 << pair) ^ (1 << low_pair)]
+            return (TWO_PAIRS << STRENGTH_SHIFT) | (pair << 16) | (low_pair << 12) | (kickers << 8)
+        return (PAIR << STRENGTH_SHIFT) | (pair << 16) | (kicker_tables[3][mask ^ (1 << pair)] << 4)
+    return kicker_tables[5][mask]
+
+#
+# Evaluator state for a set of cards: the value masks score_masks takes, then
+# the value mask and card count of each suit. Cards can be added to it a street
+# at a time without going back over the earlier ones.
+#
+EMPTY_HAND_STATE = (0, 0, 0, 0, (0, 0, 0, 0), (0, 0, 0, 0))
+
+def add_cards(state, cards):
+    mask, pairs, trips, quads, suit_masks, suit_counts = state
+    suit_masks = list(suit_masks)
+    suit_counts = list(suit_counts)
+    for card in cards:
+        bit = card_bits[card]
+        if mask & bit:
+            if pairs & bit:
+                if trips & bit:
+                    quads |= bit
+                else:
+                    trips |= bit
+            else:
+                pairs |= bit
         else:
+            mask |= bit
+        suit = card & 3
+        suit_masks[suit] |= bit
+        suit_counts[suit] += 1
+    return (mask, pairs, trips, quads, suit_masks, suit_counts)
+
+def state_strength(state):
+    mask, pairs, trips, quads, suit_masks, suit_counts = state
+    flush_mask = 0
+    for suit in range(4):
+        if suit_counts[suit] >= 5:
+            flush_mask = suit_masks[suit]
+    return score_masks(mask, pairs, trips, quads, flush_mask)
+
+def best_hand_strength(cards):
+    #
+    # Strength of the best 5 card hand out of 5 to 7 cards, in a single pass
+    #
+    return state_strength(add_cards(EMPTY_HAND_STATE, cards))
+
+#
+# NumPy versions of the tables for scoring whole batches of hands at once. Per
+# card, the value bit, a key that adds up to a base 5 count of every value, and
+# a key that adds up to a 3-bit count per suit.
+#
+np_straight_table = np.array(straight_table, dtype=np.int64)
+np_kicker_tables = [np.array(table, dtype=np.int64) for table in kicker_tables]
+np_card_bits = np.array(card_bits, dtype=np.int64)
+card_value_keys = [5 ** (card >> 2) for card in full_deck]
+card_suit_keys = [1 << (3 * (card & 3)) for card in full_deck]
+np_card_value_keys = np.array(card_value_keys, dtype=np.int64)
+np_card_suit_keys = np.array(card_suit_keys, dtype=np.int64)
+
+#
+# Strength of every multiset of 5 to 7 values when there is no flush, sorted by
+# value key. Built on first use.
+#
+value_keys = None
+value_strengths = None
+
+def build_value_table():
+    keys = []
+    strengths = []
+    for n in range(5, 8):
+        for values in itertools.combinations_with_replacement(card_values, n):
+            counts = [(values.count(value), value) for value in set(values)]
+            if max(counts)[0] > 4:
+                continue
+            mask = pairs = trips = quads = key = 0
+            for count, value in counts:
+                bit = 1 << value
+                mask |= bit
+                if count >= 2:
+                    pairs |= bit
+                if count >= 3:
+                    trips |= bit
+                if count >= 4:
+                    quads |= bit
+                key += count * 5 ** (value - 2)
+            keys.append(key)
+            strengths.append(score_masks(mask, pairs, trips, quads, 0))
+    order = np.argsort(keys)
+    return np.array(keys, dtype=np.int64)[order], np.array(strengths, dtype=np.int64)[order]
+
+def batch_strengths(cards):
+    #
+    # Vectorized best_hand_strength. cards is an int array whose last axis
+    # holds 5 to 7 cards; returns the strengths with that axis removed.
+    #
+    cards = np.asarray(cards)
+    return key_strengths(cards, np_card_value_keys[cards].sum(axis=-1), np_card_suit_keys[cards].sum(axis=-1))
+
+def key_strengths(cards, card_value_keys, suit_keys):
+    #
+    # batch_strengths from the summed value and suit keys of the cards, which
+    # can be carried from street to street by adding the new cards' keys.
+    # The cards themselves are only looked at for flushes.
+    #
+    global value_keys, value_strengths
+    if value_keys is None:
+        value_keys, value_strengths = build_value_table()
+
+    strengths = value_strengths[np.searchsorted(value_keys, card_value_keys)]
+
+    #
+    # With at most 7 cards a flush can't be beaten by anything but a straight
+    # flush out of the same suit, so only flushed hands need rescoring
+    #
+    flush_suit = np.full(strengths.shape, -1)
+    for suit in range(4):
+        flush_suit[(suit_keys >> (3 * suit)) & 7 >= 5] = suit
+    flushes = np.nonzero(flush_suit >= 0)
+    if len(flushes[0]):
+        flush_cards = cards[flushes]
+        in_suit = (flush_cards & 3) == flush_suit[flushes][:, None]
+        flush_mask = (np_card_bits[flush_cards] * in_suit).sum(axis=-1)
+        high = np_straight_table[flush_mask]
+        strengths[flushes] = np.where(
+            high > 0,
+            (STRAIGHT_FLUSH << STRENGTH_SHIFT) | (high << 16),
+            (FLUSH << STRENGTH_SHIFT) | np_kicker_tables[5][flush_mask])
+    return strengths
+
+#
+# Optional cache of best hand strengths (see new_eval_cache), used by
+# evaluate_hand when set
+#
+eval_cache = None
+CACHE_ENTRY_SAMPLE = 2 ** 15 * 2 // 3 + 1 # one past where a dict doubles its table
+
+def cache_entry_bytes():
+    #
+    # The most one cache entry costs, key and strength included, measured
+    # with tracemalloc. An entry is dearest just after the dict has doubled
+    # its table, so that is where the sample stops.
+    #
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    entries = collections.OrderedDict()
+    for i in range(CACHE_ENTRY_SAMPLE):
+        entries[(i * 7919 % 5 ** 13) << (ACE + 1)] = (i % 9 << STRENGTH_SHIFT) | i
+    size = tracemalloc.get_traced_memory()[0] - before
+    if not tracing:
+        tracemalloc.stop()
+    return int(math.ceil(float(size) / CACHE_ENTRY_SAMPLE))
+
+def new_eval_cache(max_bytes):
+    return {"entries": collections.OrderedDict(), "max_entries": max(1, max_bytes // cache_entry_bytes()),
+        "hits": 0, "misses": 0, "evictions": 0}
+
+def canonical_key(cards):
+    #
+    # Everything the strength of 5 to 7 cards depends on: how many of each
+    # value there are, and the values in the flush suit if there is one. So
+    # hands that only differ by suits, or by suits that can't make a flush,
+    # share a key.
+    #
+    value_key = suit_key = 0
+    for card in cards:
+        value_key += card_value_keys[card]
+        suit_key += card_suit_keys[card]
+    flush_mask = 0
+    if (suit_key >> 2) & (suit_key | suit_key >> 1) & 0o1111:
+        for suit in range(4):
+            if (suit_key >> (3 * suit)) & 7 >= 5:
+                for card in cards:
+                    if card & 3 == suit:
+                        flush_mask |= card_bits[card]
+    return (value_key << (ACE + 1)) | flush_mask
+
+def cached_strength(cards, cache = None):
+    #
+    # best_hand_strength through an LRU cache, eval_cache unless another is
+    # given
+    #
+    if cache is None:
+        cache = eval_cache
+    key = canonical_key(cards)
+    entries = cache["entries"]
+    strength = entries.get(key)
+    if strength is not None:
+        cache["hits"] += 1
+        entries.move_to_end(key)
+        return strength
+    cache["misses"] += 1
+    strength = best_hand_strength(cards)
+    entries[key] = strength
+    if len(entries) > cache["max_entries"]:
+        entries.popitem(last=False)
+        cache["evictions"] += 1
+    return strength
+
+def warm_eval_cache(cache):
+    #
+    # Fill the cache with every hand without a flush, as far as it has room.
+    # Done before the worker processes are forked, they all start from these
+    # entries rather than each missing them in turn.
+    #
+    global value_keys, value_strengths
+    if value_keys is None:
+        value_keys, value_strengths = build_value_table()
+    entries = cache["entries"]
+    for key, strength in zip(value_keys.tolist(), value_strengths.tolist()):
+        if len(entries) >= cache["max_entries"]:
             break
+        entries[key << (ACE + 1)] = strength
+
+def eval_cache_stats(cache = None):
+    if cache is None:
+        cache = eval_cache
+    lookups = cache["hits"] + cache["misses"]
+    return {"hits": cache["hits"], "misses": cache["misses"], "evictions": cache["evictions"],
+        "entries": len(cache["entries"]), "max_entries": cache["max_entries"],
+        "hit_rate": float(cache["hits"]) / lookups if lookups else 0.0}
 
-    if len(winners) > 1:
-        if max_ranking == STRAIGHT_FLUSH:           
-            high_straight = max([straight_rank(hand) for hand in winners])
-            for hand in winners:
-                if high_straight not in [get_value(card) for card in hand]:
-                    winners.remove(hand)
-        elif max_ranking == FOUR_OF_A_KIND:
-            high_four = max([has_num_cards_ranking(hand, 4) for hand in winners])
-            for hand in winners:
-                if high_four not in [get_value(card) for card in hand]:
-                    winners.remove(hand)
-        elif max_ranking == FULL_HOUSE:
-            high_three = max([has_num_cards_ranking(hand, 3) for hand in winners])
-            for hand in winners:
-                if high_three not in [get_value(card) for card in hand]:
-                    winners.remove(hand)
-        elif max_ranking == FLUSH:
-            kickers = [(hand, get_kickers(hand)) for hand in winners]
-            max_kicker = max([kicker[1] for kicker in kickers])
-            winners = [hand[0] for hand in kickers if hand[1] == max_kicker]
-        elif max_ranking == STRAIGHT:       
-            high_straight = max([straight_rank(hand) for hand in winners])
-            for hand in winners:
-                if high_straight not in [get_value(card) for card in hand]:
-                    winners.remove(hand)
-        elif max_ranking == SET:
-            high_set = max([has_num_cards_ranking(hand, 3) for hand in winners])
-            for hand in winners:
-                if high_set not in [get_value(card) for card in hand]:
-                    winners.remove(hand)
-            if len(winners) > 1: 
-                # Down to kickers
-                kickers = [(hand, get_kickers(hand)) for hand in winners]
-                max_kicker = max([kicker[1] for kicker in kickers])
-                winners = [hand[0] for hand in kickers if hand[1] == max_kicker]
-        elif max_ranking == TWO_PAIRS:
-            pairs = sorted([has_num_cards_ranking(hand, 2) for hand in winners], reverse = True)
-            high_pair = pairs[0]
-          
-            winners = [hand for hand in winners if has_num_cards_ranking(hand, 2) == high_pair]
-            if len(winners) > 1:
-                # We might have the same top pair but different bottom pairs
-                candidates = [[card for card in hand if get_value(card) != high_pair] for hand in winners]
-                second_pair = sorted([has_num_cards_ranking(hand, 2) for hand in candidates], reverse = True)
-                second_pair_value = second_pair[0]
-                winners = [hand for hand in winners if has_pair_of(hand, second_pair_value)] 
-                if len(winners) > 1: 
-                    # We have the same two pair!
-                    kickers = [(hand, sorted([k for k in [v[0] for v in hand] if k != high_pair and k != second_pair_value])) for hand in winners]
-                    max_kicker = max([kicker[1] for kicker in kickers])
-                    winners = [hand[0] for hand in kickers if hand[1] == max_kicker]
-        elif max_ranking == PAIR:
-            pairs = [has_num_cards_ranking(hand, 2) for hand in winners]
-            high_pair = max(pairs)
-            winners = [hand for hand in winners if has_num_cards_ranking(hand, 2) == high_pair]
-            if len(winners) > 1: 
-                # Down to kickers
-                kickers = [(hand, get_kickers(hand)) for hand in winners]
-                max_kicker = max([kicker[1] for kicker in kickers])
-                winners = [hand[0] for hand in kickers if hand[1] == max_kicker]
-        elif max_ranking == HIGH_CARD:                        
-            kickers = [(hand, get_kickers(hand)) for hand in winners]
-            max_kicker = max([kicker[1] for kicker in kickers])
-            winners = [hand[0] for hand in kickers if hand[1] == max_kicker]
-    return winners
+def evaluate_hand(cards):
+    if eval_cache is not None:
+        return cached_strength(cards)
+    return best_hand_strength(cards)
+
+def get_winners(hands):
+    #
+    # Five card hands are looked up directly, bigger ones (hole cards and
+    # field) go through evaluate_hand
+    #
+    strengths = [(hand_strength(hand) if len(hand) == 5 else evaluate_hand(hand), hand) for hand in hands]
+    max_strength = max([strength[0] for strength in strengths])
+    return [hand for strength, hand in strengths if strength == max_strength]
 
 def get_best_holdem_hand(hole, field):
-    possible_hands = itertools.combinations(hole + field, 5)
-    return get_winners(possible_hands)[0]
+    #
+    # Only needed when the actual cards are wanted, strength comparisons
+    # should use best_hand_strength
+    #
+    best = evaluate_hand(hole + field)
+    for hand in itertools.combinations(hole + field, 5):
+        if hand_strength(hand) == best:
+            return hand
 
-def run_hold_em_hand(num_hands, against = None, flop_only = False):
-    deck = get_deck()
-    if against is not None:
-        for card in against:
-            deck.remove(card)
-    hands = [[deal(deck) for i in range(2)] for j in range(num_hands)]
+def run_hold_em_hand(num_hands, against = None, flop_only = False, rng = random, dealer = None):
+    #
+    # dealer (see new_dealer) must already leave out against. Without one, a
+    # fresh one is made from rng.
+    #
+    if stage_stats is not None:
+        start = time.perf_counter()
+    if dealer is None:
+        dealer = new_dealer(against or (), rng)
+    cards = deal_cards(dealer, 2 * num_hands + (5 if not flop_only else 3))
+    hands = [cards[2 * j:2 * j + 2] for j in range(num_hands)]
     if against is not None:
         hands.append(against)
-    field = [deal(deck) for i in range(5 if not flop_only else 3)]
+    field = cards[2 * num_hands:]
+    if stage_stats is not None:
+        dealt = time.perf_counter()
 
-    best_hands = []
-    for hole in hands:
-        best_hand = get_best_holdem_hand(hole, field)
-        best_hands.append((hole, best_hand))
+    strengths = [evaluate_hand(hole + field) for hole in hands]
+    if stage_stats is not None:
+        evaluated = time.perf_counter()
 
-    winners = get_winners([hand[1] for hand in best_hands])
-    hole_winners = [c[0] for c in best_hands if c[1] in winners]
+    max_strength = max(strengths)
+    hole_winners = [hole for hole, strength in zip(hands, strengths) if strength == max_strength]
+
+    if stage_stats is not None:
+        runner_up = sorted(strengths)[-2] if len(strengths) > 1 else 0
+        record_stages(1, len(hands), len(hands) * 2 - 2 * (against is not None) + len(field),
+            dealt - start, evaluated - dealt, time.perf_counter() - evaluated,
+            np.array([max_strength]), np.array([runner_up]))
 
     if debug:
+        best_hand = get_best_holdem_hand(hole_winners[0], field)
         print("field: %s" % format_hand(field))
         print("winning hands:")
         for winner in hole_winners:
             print("\t%s" % format_hand(winner))
-        print("%s: %s" % (format_hand(sorted(winners[0])), format_rank(hand_rank(winners[0]))))
-    return hole_winners, winners
+        print("%s: %s" % (format_hand(sorted(best_hand)), format_rank(strength_rank(max_strength))))
+    return hole_winners, max_strength
+
+def new_stats():
+    return {
+        "timers": {"deal": 0.0, "evaluate": 0.0, "showdown": 0.0},
+        "counters": {"hands": 0, "evaluations": 0, "cards_dealt": 0, "cache_hits": 0, "cache_misses": 0},
+        "tie_break_depth": {},
+        "starting_hands": {},
+    }
+
+def merge_stats(stats, more):
+    for group in ("timers", "counters"):
+        for name, value in more[group].items():
+            stats[group][name] += value
+    for rank, depths in more["tie_break_depth"].items():
+        into = stats["tie_break_depth"].setdefault(rank, {})
+        for depth, count in depths.items():
+            into[depth] = into.get(depth, 0) + count
+    for hand, timing in more["starting_hands"].items():
+        into = stats["starting_hands"].setdefault(hand, {"trials": 0, "seconds": 0.0})
+        into["trials"] += timing["trials"]
+        into["seconds"] += timing["seconds"]
+        into["hands_per_sec"] = into["trials"] / into["seconds"] if into["seconds"] else 0.0
+    return stats
+
+def tie_break_depths(best, runner_up):
+    #
+    # How far down the strengths the showdown had to look: 0 when the ranks
+    # differ, 1-5 for the tie break slot that decided it, 6 for a split pot
+    #
+    diff = np.asarray(best) ^ np.asarray(runner_up)
+    depth = np.full(diff.shape, 6)
+    for slot in range(5, 0, -1):
+        depth[diff >= (1 << (4 * (5 - slot)))] = slot
+    depth[diff >= (1 << STRENGTH_SHIFT)] = 0
+    return depth
+
+def record_stages(hands, evaluations, cards_dealt, deal_time, evaluate_time, showdown_time, best, runner_up):
+    stage_stats["timers"]["deal"] += deal_time
+    stage_stats["timers"]["evaluate"] += evaluate_time
+    stage_stats["timers"]["showdown"] += showdown_time
+    stage_stats["counters"]["hands"] += hands
+    stage_stats["counters"]["evaluations"] += evaluations
+    stage_stats["counters"]["cards_dealt"] += cards_dealt
+    depths = tie_break_depths(best, runner_up)
+    ranks = np.asarray(best) >> STRENGTH_SHIFT
+    for rank in range(9):
+        in_rank = depths[ranks == rank]
+        if len(in_rank):
+            histogram = stage_stats["tie_break_depth"].setdefault(format_rank(rank), {})
+            for depth, count in zip(*np.unique(in_rank, return_counts=True)):
+                histogram[str(depth)] = histogram.get(str(depth), 0) + int(count)
+
+def new_counts():
+    #
+    # Raw results for one starting hand. wins counts every hand the test hand
+    # won or split, ties the ones it split, and ranks is the winning rank
+    # histogram over the wins.
+    #
+    return {"trials": 0, "wins": 0, "ties": 0, "ranks": [0] * 9}
+
+def merge_counts(counts, more):
+    counts["trials"] += more["trials"]
+    counts["wins"] += more["wins"]
+    counts["ties"] += more["ties"]
+    counts["ranks"] = [a + b for a, b in zip(counts["ranks"], more["ranks"])]
+    return counts
+
+def count_hand(counts, test_hand, hole_winners, strength):
+    #
+    # Add one showdown, as run_hold_em_hand returns it, to the counts
+    #
+    if test_hand in hole_winners:
+        counts["wins"] += 1
+        if len(hole_winners) > 1:
+            counts["ties"] += 1
+        counts["ranks"][strength_rank(strength)] += 1
+    counts["trials"] += 1
+
+CI_Z = 1.96 # 95% confidence
+
+def confidence_interval(counts, z = CI_Z):
+    #
+    # Wilson score interval for the win rate, which behaves near 0 and 1
+    #
+    n = float(counts["trials"])
+    if not n:
+        return 0.0, 1.0
+    p = counts["wins"] / n
+    denominator = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denominator
+    half_width = z * (p * (1 - p) / n + z * z / (4 * n * n)) ** 0.5 / denominator
+    return centre - half_width, centre + half_width
+
+def deal_batch(deck, rng, n, num_players, test_hand, field_size):
+    #
+    # Deal n tables from deck, which leaves out test_hand. Returns every
+    # player's hole cards, test hand last, and the fields.
+    #
+    num_opponent_cards = 2 * (num_players - 1)
+    dealt = deck[rng.random((n, len(deck))).argsort(axis=1)[:, :num_opponent_cards + field_size]]
+    holes = dealt[:, :num_opponent_cards].reshape(n, num_players - 1, 2)
+    holes = np.concatenate([holes, np.broadcast_to(np.array(test_hand), (n, 1, 2))], axis=1)
+    return holes, dealt[:, num_opponent_cards:]
+
+def run_hold_em_batch(num_hands, num_players, test_hand, flop_only = False, batch_size = 10000, rng = None,
+        counts = None, progress = None):
+    #
+    # Same as running run_hold_em_hand num_hands times, but deals and scores
+    # batch_size hands at a time with NumPy. Returns the counts (see new_counts).
+    # Starting from partial counts carries on after counts["trials"] hands, and
+    # progress(counts, rng) is called after every batch.
+    #
+    if rng is None:
+        rng = np.random.default_rng()
+    deck = np.array([card for card in full_deck if card not in test_hand], dtype=np.int64)
+    field_size = 5 if not flop_only else 3
+    num_dealt = 2 * (num_players - 1) + field_size
+
+    if counts is None:
+        counts = new_counts()
+    winning_rank = np.array(counts["ranks"], dtype=np.int64)
+    done = counts["trials"]
+    while done < num_hands:
+        n = min(batch_size, num_hands - done)
+        if verbose:
+            print("Running hand %d" % done)
+        if stage_stats is not None:
+            start = time.perf_counter()
+        holes, field = deal_batch(deck, rng, n, num_players, test_hand, field_size)
+        field = np.broadcast_to(field[:, None, :], (n, num_players, field_size))
+        if stage_stats is not None:
+            dealt_time = time.perf_counter()
+        strengths = batch_strengths(np.concatenate([holes, field], axis=2))
+        if stage_stats is not None:
+            evaluated = time.perf_counter()
+
+        max_strength = count_showdowns(counts, winning_rank, strengths)
+        if stage_stats is not None:
+            runner_up = np.sort(strengths, axis=1)[:, -2]
+            record_stages(n, n * num_players, n * num_dealt, dealt_time - start, evaluated - dealt_time,
+                time.perf_counter() - evaluated, max_strength, runner_up)
+        done += n
+        counts["trials"] = done
+        counts["ranks"] = [int(count) for count in winning_rank]
+        if progress is not None:
+            progress(counts, rng)
+    return counts
+
+def count_showdowns(counts, winning_rank, strengths):
+    #
+    # Add a batch of showdowns, one row of strengths each with the test hand
+    # last, to the counts. Returns the winning strengths.
+    #
+    max_strength = strengths.max(axis=1)
+    won = strengths[:, -1] == max_strength
+    counts["wins"] += int(won.sum())
+    counts["ties"] += int((won & ((strengths == max_strength[:, None]).sum(axis=1) > 1)).sum())
+    winning_rank += np.bincount(max_strength[won] >> STRENGTH_SHIFT, minlength=9)
+    return max_strength
+
+STREETS = [("flop", 3), ("turn", 4), ("river", 5)]
+
+def run_hold_em_streets_hand(num_hands, against, rng = random, dealer = None):
+    #
+    # run_hold_em_hand for the flop, turn and river of the same deal. Each
+    # player's evaluator state is carried from one street to the next, so the
+    # turn and river only add their one card. Returns (hole_winners,
+    # max_strength) for each street.
+    #
+    if dealer is None:
+        dealer = new_dealer(against, rng)
+    cards = deal_cards(dealer, 2 * num_hands + 5)
+    hands = [cards[2 * j:2 * j + 2] for j in range(num_hands)]
+    hands.append(against)
+    field = cards[2 * num_hands:]
+
+    results = []
+    states = [EMPTY_HAND_STATE] * len(hands)
+    dealt = 0
+    for street, field_size in STREETS:
+        states = [add_cards(state, hole + field[dealt:field_size] if not dealt else field[dealt:field_size])
+            for state, hole in zip(states, hands)]
+        dealt = field_size
+        strengths = [state_strength(state) for state in states]
+        max_strength = max(strengths)
+        results.append(([hole for hole, strength in zip(hands, strengths) if strength == max_strength], max_strength))
+    return results
+
+def run_hold_em_streets_batch(num_hands, num_players, test_hand, batch_size = 10000, rng = None):
+    #
+    # run_hold_em_batch for all three streets of each deal. The value and suit
+    # keys of every hand are summed up street by street (see key_strengths).
+    # Returns a list of counts, in the order of STREETS.
+    #
+    if rng is None:
+        rng = np.random.default_rng()
+    deck = np.array([card for card in full_deck if card not in test_hand], dtype=np.int64)
+
+    counts = [new_counts() for street in STREETS]
+    winning_ranks = np.zeros((len(STREETS), 9), dtype=np.int64)
+    done = 0
+    while done < num_hands:
+        n = min(batch_size, num_hands - done)
+        if verbose:
+            print("Running hand %d" % done)
+        holes, field = deal_batch(deck, rng, n, num_players, test_hand, 5)
+
+        card_value_keys = np_card_value_keys[holes].sum(axis=-1)
+        suit_keys = np_card_suit_keys[holes].sum(axis=-1)
+        dealt_before = 0
+        for k, (street, field_size) in enumerate(STREETS):
+            new_cards = field[:, dealt_before:field_size]
+            card_value_keys = card_value_keys + np_card_value_keys[new_cards].sum(axis=-1)[:, None]
+            suit_keys = suit_keys + np_card_suit_keys[new_cards].sum(axis=-1)[:, None]
+            dealt_before = field_size
+            cards = np.concatenate([holes, np.broadcast_to(field[:, None, :field_size], (n, num_players, field_size))], axis=2)
+            count_showdowns(counts[k], winning_ranks[k], key_strengths(cards, card_value_keys, suit_keys))
+        done += n
+
+    for k in range(len(STREETS)):
+        counts[k]["trials"] = done
+        counts[k]["ranks"] = [int(count) for count in winning_ranks[k]]
+    return counts
+
+def run_hold_em_sizes_hand(num_hands, against, flop_only = False, rng = random, dealer = None):
+    #
+    # run_hold_em_hand for every table size at once. num_hands opponents are
+    # dealt and every hand is evaluated once, then the showdown is read off
+    # against the first 1, 2, ... num_hands of them. Returns (hole_winners,
+    # max_strength) for each size, smallest first.
+    #
+    if dealer is None:
+        dealer = new_dealer(against, rng)
+    cards = deal_cards(dealer, 2 * num_hands + (5 if not flop_only else 3))
+    hands = [cards[2 * j:2 * j + 2] for j in range(num_hands)]
+    field = cards[2 * num_hands:]
+    strengths = [evaluate_hand(hole + field) for hole in hands]
+    test_strength = evaluate_hand(against + field)
+
+    results = []
+    best_opponent = -1
+    for k in range(num_hands):
+        best_opponent = max(best_opponent, strengths[k])
+        max_strength = max(best_opponent, test_strength)
+        hole_winners = [hole for hole, strength in zip(hands[:k + 1], strengths[:k + 1]) if strength == max_strength]
+        if test_strength == max_strength:
+            hole_winners.append(against)
+        results.append((hole_winners, max_strength))
+    return results
+
+def run_hold_em_sizes_batch(num_hands, max_players, test_hand, flop_only = False, batch_size = 10000, rng = None):
+    #
+    # run_hold_em_batch for every table size from 2 to max_players players
+    # in one pass over max_players player deals. The test hand wins against
+    # the first k opponents when it beats the running maximum of their
+    # strengths. Returns a list of counts, 2 players first.
+    #
+    if rng is None:
+        rng = np.random.default_rng()
+    deck = np.array([card for card in full_deck if card not in test_hand], dtype=np.int64)
+    field_size = 5 if not flop_only else 3
+
+    counts = [new_counts() for k in range(max_players - 1)]
+    winning_ranks = np.zeros((max_players - 1) * 9, dtype=np.int64)
+    sizes = np.arange(max_players - 1)
+    done = 0
+    while done < num_hands:
+        n = min(batch_size, num_hands - done)
+        if verbose:
+            print("Running hand %d" % done)
+        holes, field = deal_batch(deck, rng, n, max_players, test_hand, field_size)
+        field = np.broadcast_to(field[:, None, :], (n, max_players, field_size))
+        strengths = batch_strengths(np.concatenate([holes, field], axis=2))
+
+        best_opponent = np.maximum.accumulate(strengths[:, :-1], axis=1)
+        test_strengths = strengths[:, -1:]
+        won = test_strengths >= best_opponent
+        tied = test_strengths == best_opponent
+        for k in range(max_players - 1):
+            counts[k]["wins"] += int(won[:, k].sum())
+            counts[k]["ties"] += int(tied[:, k].sum())
+        winning_ranks += np.bincount((sizes * 9 + (test_strengths >> STRENGTH_SHIFT))[won], minlength=len(winning_ranks))
+        done += n
+
+    for k in range(max_players - 1):
+        counts[k]["trials"] = done
+        counts[k]["ranks"] = [int(count) for count in winning_ranks[k * 9:(k + 1) * 9]]
+    return counts
+
+def suit_permutations(cards, board = ()):
+    #
+    # Every relabelling of the suits that maps this set of cards onto itself,
+    # and the board, if any, onto itself too
+    #
+    ret = []
+    for perm in itertools.permutations(range(4)):
+        if all(sorted([(card & ~3) | perm[card & 3] for card in group]) == sorted(group) for group in (cards, board)):
+            ret.append(perm)
+    return ret
+
+def card_combinations(n, k):
+    return np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(n), k)), dtype=np.int8).reshape(-1, k)
+
+def board_classes(test_hand, board = (), field_size = 5):
+    #
+    # Every field of field_size cards that completes board. Fields that a
+    # suit relabelling fixing the test hand and board maps onto each other
+    # score the same, so only one of each is returned, with how many there are.
+    #
+    board = list(board)
+    deck = np.array([card for card in full_deck if card not in test_hand and card not in board], dtype=np.int64)
+    if len(board) < field_size:
+        fields = deck[card_combinations(len(deck), field_size - len(board))]
+    else:
+        fields = np.zeros((1, 0), dtype=np.int64)
+    fields = np.concatenate([np.broadcast_to(np.array(board, dtype=np.int64), (len(fields), len(board))), fields], axis=1)
+
+    masks = (np.int64(1) << fields).sum(axis=1)
+    canonical = masks
+    for perm in suit_permutations(test_hand, board)[1:]:
+        permuted = (fields & ~3) | np.array(perm)[fields & 3]
+        canonical = np.minimum(canonical, (np.int64(1) << permuted).sum(axis=1))
+    keep = masks == canonical
+    classes, class_sizes = np.unique(canonical, return_counts=True)
+    return fields[keep], class_sizes[np.searchsorted(classes, masks[keep])]
+
+def exact_hold_em_hand(test_hand, flop_only = False, chunk_size = 500, board = ()):
+    #
+    # Heads up equity by enumerating every field and every opponent hand,
+    # scoring one field of each class board_classes finds. board is the part
+    # of the field already known, if any. Returns the counts (see new_counts)
+    # over all trials.
+    #
+    field_size = 5 if not flop_only else 3
+    fields, weights = board_classes(test_hand, board, field_size)
+
+    opponents = card_combinations(NUM_CARDS - len(test_hand) - field_size, 2)
+    counts = new_counts()
+    winning_rank = np.zeros(9, dtype=np.int64)
+    for start in range(0, len(fields), chunk_size):
+        chunk = fields[start:start + chunk_size]
+        chunk_weights = weights[start:start + chunk_size]
+        n = len(chunk)
+
+        #
+        # The cards left for the opponent after each field
+        #
+        live = np.ones((n, NUM_CARDS), dtype=bool)
+        live[:, test_hand] = False
+        live[np.arange(n)[:, None], chunk] = False
+        rest = np.nonzero(live)[1].reshape(n, -1)
+
+        holes = rest[:, opponents]
+        trials = int(chunk_weights.sum()) * len(opponents)
+        if stage_stats is not None:
+            eval_start = time.perf_counter()
+        opponent_strengths = batch_strengths(np.concatenate(
+            [holes, np.broadcast_to(chunk[:, None, :], (n, len(opponents), field_size))], axis=2))
+        test_strengths = batch_strengths(np.concatenate(
+            [np.broadcast_to(np.array(test_hand), (n, 2)), chunk], axis=1))
+        if stage_stats is not None:
+            stage_stats["timers"]["evaluate"] += time.perf_counter() - eval_start
+            stage_stats["counters"]["evaluations"] += n * (len(opponents) + 1)
+            stage_stats["counters"]["hands"] += trials
+
+        won = (opponent_strengths <= test_strengths[:, None]).sum(axis=1)
+        tied = (opponent_strengths == test_strengths[:, None]).sum(axis=1)
+        counts["trials"] += trials
+        counts["wins"] += int((chunk_weights * won).sum())
+        counts["ties"] += int((chunk_weights * tied).sum())
+        np.add.at(winning_rank, test_strengths >> STRENGTH_SHIFT, chunk_weights * won)
+    counts["ranks"] = [int(count) for count in winning_rank]
+    return counts
+
+RANGE_VALUE = '(10|[2-9TJQKA])'
+RANGE_CLASS = re.compile(RANGE_VALUE + RANGE_VALUE + '([so]?)$')
+RANGE_COMBO = re.compile(RANGE_VALUE + '([dhcs])' + RANGE_VALUE + '([dhcs])$')
+
+def parse_value(value):
+    if value == 'J':
+        return JACK
+    elif value == 'Q':
+        return QUEEN
+    elif value == 'K':
+        return KING
+    elif value == 'A':
+        return ACE
+    elif value == 'T':
+        return 10
+    return int(value)
+
+def parse_hand_class(text):
+    #
+    # "AKs" -> (ACE, KING, 's'), higher value first
+    #
+    match = RANGE_CLASS.match(text)
+    if match is None:
+        raise ValueError("bad hand in range: %s" % text)
+    high, low = sorted([parse_value(match.group(1)), parse_value(match.group(2))], reverse=True)
+    if high == low and match.group(3):
+        raise ValueError("a pair can't be suited or offsuit: %s" % text)
+    return high, low, match.group(3)
+
+def hand_class_combos(high, low, kind):
+    #
+    # Every pair of cards for a hand class. kind is 's' for suited, 'o' for
+    # offsuit, '' for both.
+    #
+    combos = []
+    for first, second in itertools.product(suits, repeat=2):
+        if high == low and suits.index(first) >= suits.index(second):
+            continue
+        if (kind == 's' and first != second) or (kind == 'o' and first == second):
+            continue
+        combos.append((make_card(high, first), make_card(low, second)))
+    return combos
+
+def parse_range(text):
+    #
+    # Hand range such as "QQ+, AKs, KQo, 76s-54s, AhKh" into a list of hole
+    # card pairs. Besides single hands and exact cards:
+    #   QQ+     QQ, KK, AA
+    #   A9s+    A9s up to AKs, raising the kicker
+    #   QQ-99   QQ down to 99
+    #   A9s-A6s A9s down to A6s
+    #   76s-54s 76s, 65s, 54s, keeping the gap
+    # AK with no s or o is both. Combos listed twice are only counted once.
+    #
+    classes = []
+    combos = []
+    for token in text.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        match = RANGE_COMBO.match(token)
+        if match is not None:
+            first = make_card(parse_value(match.group(1)), match.group(2))
+            second = make_card(parse_value(match.group(3)), match.group(4))
+            if first == second:
+                raise ValueError("same card twice in range: %s" % token)
+            combos.append((first, second))
+        elif token.endswith('+'):
+            high, low, kind = parse_hand_class(token[:-1])
+            if high == low:
+                classes += [(value, value, kind) for value in range(high, ACE + 1)]
+            else:
+                classes += [(high, value, kind) for value in range(low, high)]
+        elif '-' in token:
+            start, end = [parse_hand_class(part.strip()) for part in token.split('-', 1)]
+            if start[2] != end[2]:
+                raise ValueError("both ends must be suited or offsuit alike: %s" % token)
+            if start < end:
+                start, end = end, start
+            if start[0] == start[1] and end[0] == end[1]:
+                classes += [(value, value, start[2]) for value in range(end[0], start[0] + 1)]
+            elif start[0] == end[0]:
+                classes += [(start[0], value, start[2]) for value in range(end[1], start[1] + 1)]
+            elif start[0] - start[1] == end[0] - end[1]:
+                gap = start[0] - start[1]
+                classes += [(value, value - gap, start[2]) for value in range(end[0], start[0] + 1)]
+            else:
+                raise ValueError("bad span in range: %s" % token)
+        else:
+            classes.append(parse_hand_class(token))
+
+    for high, low, kind in classes:
+        combos += hand_class_combos(high, low, kind)
+    unique = []
+    seen = set()
+    for combo in combos:
+        if frozenset(combo) not in seen:
+            seen.add(frozenset(combo))
+            unique.append(combo)
+    return unique
+
+MAX_REDEALS = 1000
+
+def deal_ranges(ranges, n, rng):
+    #
+    # n rows of one combo from each range, drawn evenly from the combos that
+    # don't share a card. Rows that collide are redrawn whole, which keeps the
+    # card removal between the ranges right. Returns the hole cards, shaped
+    # (n, len(ranges), 2), and a mask of the cards used in each row.
+    #
+    combos = [np.array(hand_range, dtype=np.int64).reshape(-1, 2) for hand_range in ranges]
+    masks = [np.bitwise_or(*(np.uint64(1) << hand_range.astype(np.uint64)).T) for hand_range in combos]
+    picks = np.zeros((n, len(ranges)), dtype=np.int64)
+    used = np.zeros(n, dtype=np.uint64)
+    pending = np.arange(n)
+    for attempt in range(MAX_REDEALS):
+        if not len(pending):
+            break
+        picks[pending] = np.stack([rng.integers(len(hand_range), size=len(pending)) for hand_range in combos], axis=1)
+        row_used = np.zeros(len(pending), dtype=np.uint64)
+        collided = np.zeros(len(pending), dtype=bool)
+        for k in range(len(ranges)):
+            mask = masks[k][picks[pending, k]]
+            collided |= (row_used & mask) != 0
+            row_used |= mask
+        used[pending] = row_used
+        pending = pending[collided]
+    else:
+        if len(pending):
+            raise ValueError("these ranges can't be dealt without sharing cards")
+
+    holes = np.stack([combos[k][picks[:, k]] for k in range(len(ranges))], axis=1)
+    return holes, used
+
+def range_equity(hero, villains, num_hands, flop_only = False, batch_size = 10000, seed = None):
+    #
+    # Equity of a hand or range against one or more ranges, over num_hands
+    # deals. Ranges are range strings (see parse_range) or lists of hole card
+    # pairs; a single hand is a range of one. villains is a list of ranges, or
+    # one range string. Returns counts for hero (see new_counts) with one more
+    # entry, share, the pots hero won with splits divided between the winners.
+    # equity() turns that into a fraction.
+    #
+    if isinstance(villains, str):
+        villains = [villains]
+    ranges = [parse_range(hand_range) if isinstance(hand_range, str) else hand_range
+        for hand_range in [hero] + list(villains)]
+    if min([len(hand_range) for hand_range in ranges]) == 0:
+        raise ValueError("empty range")
+    rng = np.random.default_rng(seed)
+    field_size = 5 if not flop_only else 3
+    bits = np.arange(NUM_CARDS, dtype=np.uint64)
+
+    counts = new_counts()
+    counts["share"] = 0.0
+    winning_rank = np.zeros(9, dtype=np.int64)
+    done = 0
+    while done < num_hands:
+        n = min(batch_size, num_hands - done)
+        holes, used = deal_ranges(ranges, n, rng)
+
+        #
+        # The field comes from whatever cards are left in each row
+        #
+        keys = rng.random((n, NUM_CARDS))
+        keys[((used[:, None] >> bits) & np.uint64(1)).astype(bool)] = 2.0
+        field = keys.argsort(axis=1)[:, :field_size]
+        field = np.broadcast_to(field[:, None, :], (n, len(ranges), field_size))
+        strengths = batch_strengths(np.concatenate([holes, field], axis=2))
+
+        max_strength = strengths.max(axis=1)
+        winners = (strengths == max_strength[:, None]).sum(axis=1)
+        won = strengths[:, 0] == max_strength
+        counts["wins"] += int(won.sum())
+        counts["ties"] += int((won & (winners > 1)).sum())
+        counts["share"] += float((won / winners).sum())
+        winning_rank += np.bincount(max_strength[won] >> STRENGTH_SHIFT, minlength=9)
+        done += n
+        counts["trials"] = done
+        counts["ranks"] = [int(count) for count in winning_rank]
+    return counts
+
+def equity(counts):
+    return counts["share"] / counts["trials"] if counts["trials"] else 0.0
+
+BOARD_FIRST_BATCH = 64
+BOARD_EXACT_CHUNK = 50 # about a turn's worth, so warm_tables times a full chunk
+EXACT_OPPONENTS = math.comb(NUM_CARDS - 7, 2) # heads up, once the field is out
+
+#
+# What board_equity plans a budget with, timed by warm_tables: the fixed cost
+# of a sampling batch ("batch") and each evaluation in it ("evaluation"), the
+# final tally ("tally"), and the fixed cost of enumerating ("exact") and each
+# class of run out it scores ("exact_class")
+#
+board_timings = {}
+
+def sample_board(counts, winning_rank, deck, rng, n, hole, board, num_opponents):
+    #
+    # Deal n run outs and opponent hands for board_equity and add them to the
+    # counts
+    #
+    holes, run_outs = deal_batch(deck, rng, n, num_opponents + 1, hole, 5 - len(board))
+    field = np.concatenate([np.broadcast_to(np.array(board, dtype=np.int64), (n, len(board))), run_outs], axis=1)
+    strengths = batch_strengths(np.concatenate([holes,
+        np.broadcast_to(field[:, None, :], (n, num_opponents + 1, 5))], axis=2))
+
+    max_strength = strengths.max(axis=1)
+    winners = (strengths == max_strength[:, None]).sum(axis=1)
+    won = strengths[:, -1] == max_strength
+    counts["trials"] += n
+    counts["wins"] += int(won.sum())
+    counts["ties"] += int((won & (winners > 1)).sum())
+    counts["share"] += float((won / winners).sum())
+    winning_rank += np.bincount(max_strength[won] >> STRENGTH_SHIFT, minlength=9)
+
+def board_result(counts, winning_rank):
+    counts["ranks"] = [int(count) for count in winning_rank]
+    low, high = confidence_interval({"trials": counts["trials"], "wins": counts["share"]})
+    estimate = equity(counts)
+    return estimate, max(high - estimate, estimate - low), counts
+
+def exact_board(hole, board):
+    #
+    # board_equity's answer by enumerating
+    #
+    counts = exact_hold_em_hand(hole, False, BOARD_EXACT_CHUNK, board)
+    counts["share"] = counts["wins"] - counts["ties"] / 2.0
+    counts["exact"] = True
+    return counts
+
+def median_seconds(fn, repeats):
+    seconds = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return sorted(seconds)[repeats // 2]
+
+def warm_tables():
+    #
+    # Build the lookup tables and load np.random ahead of anything with a
+    # time budget, since both happen on first use, then fill in board_timings
+    #
+    batch_strengths(np.array([full_deck[:7]]))
+    rng = np.random.default_rng()
+
+    #
+    # A batch of one deal is all fixed cost. The evaluations are timed on a
+    # batch of the size board_equity's batches grow to.
+    #
+    hole = [make_card(2, CLUBS), make_card(7, DIAMONDS)]
+    river = [make_card(9, HEARTS), make_card(JACK, SPADES), make_card(QUEEN, CLUBS), make_card(KING, DIAMONDS), make_card(ACE, HEARTS)]
+    deck = np.array([card for card in full_deck if card not in hole + river[:3]], dtype=np.int64)
+    counts = dict(new_counts(), share=0.0)
+    winning_rank = np.zeros(9, dtype=np.int64)
+    board_timings["batch"] = median_seconds(lambda: sample_board(counts, winning_rank, deck, rng, 1, hole, river[:3], 1), 20)
+    board_timings["evaluation"] = max(median_seconds(lambda: sample_board(counts, winning_rank, deck, rng, 10000, hole, river[:3], 1), 5) -
+        board_timings["batch"], 0.0) / 20000
+    board_timings["tally"] = median_seconds(lambda: board_result(counts, winning_rank), 20)
+
+    #
+    # The river is one class of run out, the turn one per card left since no
+    # two suits of the hole cards and board can be swapped
+    #
+    river_seconds = median_seconds(lambda: exact_board(hole, river), 5)
+    turn_seconds = median_seconds(lambda: exact_board(hole, river[:4]), 5)
+    board_timings["exact_class"] = max(turn_seconds - river_seconds, 0.0) / (len(board_classes(hole, river[:4])[0]) - 1)
+    board_timings["exact"] = max(river_seconds - board_timings["exact_class"], 0.0)
+
+def board_equity(hole, board, num_opponents = 1, budget = None, max_samples = None, batch_size = 10000, seed = None):
+    #
+    # Anytime equity of hole cards on a known board (none, the flop, turn or
+    # river) against num_opponents random hands, to the river. Samples in
+    # batches sized to finish within budget seconds, or until max_samples
+    # deals, whichever comes first. Heads up, when enumerating every
+    # opponent hand and run out (exact_hold_em_hand) fits in both, that is
+    # done instead and the answer is exact. The river is always enumerated.
+    #
+    # Returns the equity, its error bound, and counts (see new_counts) with
+    # share as in range_equity and exact. The bound is the half width of the
+    # 95% Wilson interval on the share, which holds for any pot split since
+    # each deal's share is between 0 and 1, and 0 when exact. With a budget,
+    # warm_tables() has to have been called first, so the tables and timings
+    # aren't built against the deadline. One batch of BOARD_FIRST_BATCH deals
+    # is always sampled, even when the budget is too short for it.
+    #
+    if budget is None and max_samples is None:
+        raise ValueError("need a budget or max_samples")
+    if budget is not None and not board_timings:
+        raise ValueError("call warm_tables() before board_equity with a budget")
+    if max_samples is not None and max_samples < 1:
+        raise ValueError("max_samples must be at least 1")
+    started = time.perf_counter()
+    hole = list(hole)
+    board = list(board)
+    if len(set(hole + board)) != len(hole + board) or len(hole) != 2 or len(board) > 5:
+        raise ValueError("need 2 hole cards and up to 5 board cards, all different")
+    rng = np.random.default_rng(seed)
+    deck = np.array([card for card in full_deck if card not in hole and card not in board], dtype=np.int64)
+    missing = 5 - len(board)
+    if missing + 2 * num_opponents > len(deck):
+        raise ValueError("not enough cards for %d opponents" % num_opponents)
 
-def run_five_card_sim(num_runs, num_hands):   
+    #
+    # Enumerating scores each opponent hand and the hole cards once per class
+    # of run out left after the suit symmetry. The classes are counted from
+    # the flop on; before it there are too many to list quickly, and nearly
+    # all are full sized, so the run outs are divided by the relabellings.
+    # The timings are of a warm turn, and boards dealt cold cost up to a
+    # fifth more.
+    #
+    if num_opponents == 1:
+        if missing <= 2:
+            num_classes = len(board_classes(hole, board)[0])
+        else:
+            num_classes = math.comb(len(deck), missing) / float(len(suit_permutations(hole, board)))
+        fits = not missing or (
+            (max_samples is None or num_classes * (EXACT_OPPONENTS + 1) <= max_samples * (num_opponents + 1)) and
+            (budget is None or 1.2 * (board_timings["exact"] + num_classes * board_timings["exact_class"]) <=
+                started + budget - time.perf_counter()))
+        if fits:
+            counts = exact_board(hole, board)
+            return equity(counts), 0.0, counts
+
+    counts = new_counts()
+    counts["share"] = 0.0
+    counts["exact"] = False
+    winning_rank = np.zeros(9, dtype=np.int64)
+    n = BOARD_FIRST_BATCH
+    while True:
+        if budget is not None and counts["trials"]:
+            #
+            # Leave room for the fixed cost of the batch and the final tally.
+            # A batch only takes half of what's left, so one that runs twice
+            # as long as planned still finishes in time, and the last few
+            # shrink until they would be too small to be worth their fixed
+            # cost.
+            #
+            left = started + budget - time.perf_counter() - board_timings["batch"] - board_timings["tally"]
+            fit = int(left / (2 * seconds_per_evaluation * (num_opponents + 1)))
+            if fit < BOARD_FIRST_BATCH:
+                break
+            n = min(n, fit)
+        if max_samples is not None:
+            n = min(n, max_samples - counts["trials"])
+        if n <= 0:
+            break
+
+        batch_start = time.perf_counter()
+        sample_board(counts, winning_rank, deck, rng, n, hole, board, num_opponents)
+
+        #
+        # What each evaluation cost over the batch's fixed cost. Bigger
+        # batches cost more per evaluation, so batches only grow fourfold at
+        # a time for this to still hold for the next one.
+        #
+        if budget is not None:
+            seconds_per_evaluation = max(time.perf_counter() - batch_start - board_timings["batch"], 0.0) / (n * (num_opponents + 1))
+            seconds_per_evaluation = max(seconds_per_evaluation, board_timings["evaluation"])
+        n = min(4 * n, batch_size)
+
+    return board_result(counts, winning_rank)
+
+def run_five_card_hands(num_runs, num_hands, rng = random):
     winning_rank = [0] * 9
+    dealer = new_dealer((), rng)
     for i in range(num_runs):    
-        deck = get_deck()
         num_cards = 5
-        hands = [[deal(deck) for i in range(num_cards)] for j in range(num_hands)] 
+        cards = deal_cards(dealer, num_cards * num_hands)
+        hands = [cards[j * num_cards:(j + 1) * num_cards] for j in range(num_hands)]
 
         if verbose:
             for hand in hands:
@@ -387,38 +1484,379 @@ def run_five_card_sim(num_runs, num_hands):
             print("Winners with %s" % format_rank(hand_rank(winners[0])))
             for winner in winners:
                 print("\t%s" % format_hand(winner))
+    return winning_rank
 
-    for i in range(len(winning_rank)):
-        print("%s: %d" % (format_rank(i), winning_rank[i]))
+def run_five_card_batch(num_runs, num_hands, batch_size = 10000, rng = None):
+    #
+    # run_five_card_hands dealing and scoring batch_size tables at a time
+    #
+    if rng is None:
+        rng = np.random.default_rng()
+    winning_rank = np.zeros(9, dtype=np.int64)
+    done = 0
+    while done < num_runs:
+        n = min(batch_size, num_runs - done)
+        dealt = rng.random((n, NUM_CARDS)).argsort(axis=1)[:, :5 * num_hands].reshape(n, num_hands, 5)
+        winning_rank += np.bincount(batch_strengths(dealt).max(axis=1) >> STRENGTH_SHIFT, minlength=9)
+        done += n
+    return [int(count) for count in winning_rank]
+
+FIVE_CARD_CHUNK = 1000000
+
+def run_five_card_chunk(task):
+    index, num_runs, num_hands, batch_size, seed = task
+    if batch_size:
+        return run_five_card_batch(num_runs, num_hands, batch_size, np.random.default_rng(seed))
+    return run_five_card_hands(num_runs, num_hands, np.random.default_rng(seed))
+
+def run_five_card_sim(num_runs, num_hands, batch_size = None, workers = 1, seed = None):
+    #
+    # Winning rank histogram over num_runs deals of num_hands five card hands.
+    # The deals are split into chunks with their own random streams, spread
+    # over workers processes.
+    #
+    tasks = [(k, min(FIVE_CARD_CHUNK, num_runs - start), num_hands, batch_size, np.random.SeedSequence(seed, spawn_key=(k,)))
+        for k, start in enumerate(range(0, num_runs, FIVE_CARD_CHUNK))]
+    winning_rank = [0] * 9
+    with worker_pool(workers) as pool:
+        for more in map_tasks(run_five_card_chunk, tasks, pool):
+            winning_rank = [a + b for a, b in zip(winning_rank, more)]
+    return winning_rank
 
-def run_hold_em_hand_sim(num_hands, num_players, test_hand, flop_only = False):
-    wins = 0
-    winning_rank = [0] * 9 # number of ranks to keep track of
-    for i in range(num_hands): 
-        if verbose and i % 100 == 0:
-            print("Running hand %d" % i)
-        hole_winners, winners = run_hold_em_hand(num_players - 1, test_hand, flop_only)
-        
-        if test_hand in hole_winners:
-            wins += 1
-            winning_rank[hand_rank(winners[0])] += 1
+def colex_index(combos):
+    #
+    # Position of each sorted combination among all combinations of its size,
+    # counting in colexicographic order
+    #
+    index = np.zeros(len(combos), dtype=np.int64)
+    for i in range(combos.shape[1]):
+        index += binomial_table[combos[:, i].astype(np.int64), i + 1]
+    return index
+
+binomial_table = np.array([[math.comb(n, k) for k in range(6)] for n in range(NUM_CARDS + 1)], dtype=np.int64)
+
+def exact_five_card(num_hands):
+    #
+    # Exact winning rank histogram for 1 or 2 five card hands, counting every
+    # deal (unordered for 2 hands). Returns the histogram and the number of
+    # deals.
+    #
+    # For 2 hands, the deals whose best rank is at most r are the pairs of
+    # disjoint hands that are both at most r. By inclusion-exclusion over the
+    # cards they share, the ordered pairs number sum over card sets S of
+    # (-1)^|S| M(S)^2, where M(S) counts the hands at most r holding S.
+    #
+    hands = card_combinations(NUM_CARDS, 5)
+    ranks = batch_strengths(hands.astype(np.int64)) >> STRENGTH_SHIFT
+    if num_hands == 1:
+        return [int(count) for count in np.bincount(ranks, minlength=9)], len(hands)
+    if num_hands != 2:
+        raise ValueError("exact five card stud only works for 1 or 2 hands")
+
+    at_most = np.zeros(9, dtype=np.int64)
+    for k in range(6):
+        counts = np.zeros(binomial_table[NUM_CARDS, k] * 9, dtype=np.int64)
+        for subset in itertools.combinations(range(5), k):
+            counts += np.bincount(colex_index(hands[:, list(subset)]) * 9 + ranks, minlength=len(counts))
+        counts = counts.reshape(-1, 9)
+        at_most += (-1) ** k * (np.cumsum(counts, axis=1) ** 2).sum(axis=0)
+
+    winning_rank = np.diff(np.concatenate([[0], at_most])) // 2
+    return [int(count) for count in winning_rank], int(at_most[-1] // 2)
+
+#
+# Omaha hands are always exactly 5 cards. five_value_strengths holds the
+# strength of every multiset of 5 values when there is no flush, by value key.
+# pair_triple_strengths holds the same indexed directly by the values of a
+# hole pair (13 * a + b, either order) and a field triple (169 * a + 13 * b + c,
+# any order), so a batch needs no searching. Built on first use.
+#
+five_value_strengths = None
+pair_triple_strengths = None
+
+def build_five_value_table():
+    global five_value_strengths, pair_triple_strengths
+    five_value_strengths = {}
+    for values in itertools.combinations_with_replacement(card_values, 5):
+        if max([values.count(value) for value in values]) > 4:
+            continue
+        five_value_strengths[sum([5 ** (value - 2) for value in values])] = score_values(list(values), False)
+
+    value_key = 5 ** np.arange(len(card_values), dtype=np.int64)
+    pair_keys = (value_key[:, None] + value_key[None, :]).reshape(-1)
+    triple_keys = (value_key[:, None, None] + value_key[None, :, None] + value_key[None, None, :]).reshape(-1)
+    keys = pair_keys[:, None] + triple_keys[None, :]
+    sorted_keys = np.array(sorted(five_value_strengths), dtype=np.int64)
+    strengths = np.array([five_value_strengths[key] for key in sorted_keys.tolist()], dtype=np.int64)
+    found = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    pair_triple_strengths = np.where(sorted_keys[found] == keys, strengths[found], 0).astype(np.int32)
+
+def flush_strength(flush_mask):
+    high = straight_table[flush_mask]
+    if high:
+        return (STRAIGHT_FLUSH << STRENGTH_SHIFT) | (high << 16)
+    return (FLUSH << STRENGTH_SHIFT) | kicker_tables[5][flush_mask]
+
+def best_omaha_strength(hole, field):
+    #
+    # Strength of the best hand using exactly 2 hole cards and 3 from the
+    # field. Rather than scoring every combination, the hole pairs and field
+    # triples are cut down to their distinct value sums first, which pairs on
+    # either side make fewer, and flushes are only looked for in suits with
+    # 2 hole cards and 3 field cards.
+    #
+    if five_value_strengths is None:
+        build_five_value_table()
+    pair_keys = set([card_value_keys[a] + card_value_keys[b] for a, b in itertools.combinations(hole, 2)])
+    triple_keys = set([card_value_keys[a] + card_value_keys[b] + card_value_keys[c]
+        for a, b, c in itertools.combinations(field, 3)])
+    best = max([five_value_strengths[pair_key + triple_key] for pair_key in pair_keys for triple_key in triple_keys])
+
+    for suit in range(4):
+        suited_field = [card_bits[card] for card in field if card & 3 == suit]
+        if len(suited_field) < 3:
+            continue
+        suited_hole = [card_bits[card] for card in hole if card & 3 == suit]
+        for a, b in itertools.combinations(suited_hole, 2):
+            for c, d, e in itertools.combinations(suited_field, 3):
+                best = max(best, flush_strength(a | b | c | d | e))
+    return best
+
+def omaha_batch_strengths(holes, field):
+    #
+    # best_omaha_strength for a batch. holes is (deals, players, hole cards),
+    # field is (deals, field cards); returns (deals, players). Each of the
+    # pair x triple hands costs one lookup in pair_triple_strengths. At most
+    # one suit can have 3 cards in a field of 5 or fewer, so flushes are only
+    # scored for the seats holding 2 of that suit.
+    #
+    if pair_triple_strengths is None:
+        build_five_value_table()
+    pairs = np.array(list(itertools.combinations(range(holes.shape[-1]), 2)))
+    triples = np.array(list(itertools.combinations(range(field.shape[-1]), 3)))
+    hole_pairs = holes[:, :, pairs]
+    field_triples = field[:, triples]
+
+    pair_values = hole_pairs >> 2
+    triple_values = field_triples >> 2
+    strengths = pair_triple_strengths[
+        (pair_values[..., 0] * 13 + pair_values[..., 1])[:, :, :, None],
+        (triple_values[..., 0] * 169 + triple_values[..., 1] * 13 + triple_values[..., 2])[:, None, None, :]]
+    best = strengths.reshape(strengths.shape[0], strengths.shape[1], -1).max(axis=2).astype(np.int64)
+
+    field_suited = (field & 3)[:, :, None] == np.arange(4)
+    flush_suit = field_suited.sum(axis=1).argmax(axis=1)
+    flush_suit = np.where(field_suited.sum(axis=1).max(axis=1) >= 3, flush_suit, -1)
+    hole_suited = (holes & 3) == flush_suit[:, None, None]
+    deal, player = np.nonzero(hole_suited.sum(axis=-1) >= 2)
+    if len(deal):
+        suited = hole_suited[deal, player][:, pairs].all(axis=-1)[:, :, None] & \
+            ((field_triples[deal] & 3) == flush_suit[deal, None, None]).all(axis=-1)[:, None, :]
+        flush_mask = np.where(suited, np_card_bits[hole_pairs[deal, player]].sum(axis=-1)[:, :, None] +
+            np_card_bits[field_triples[deal]].sum(axis=-1)[:, None, :], 0)
+        high = np_straight_table[flush_mask]
+        flushes = np.where(high > 0,
+            (STRAIGHT_FLUSH << STRENGTH_SHIFT) | (high << 16),
+            (FLUSH << STRENGTH_SHIFT) | np_kicker_tables[5][flush_mask])
+        best[deal, player] = np.maximum(best[deal, player], np.where(suited, flushes, 0).max(axis=(1, 2)))
+    return best
+
+#
+# Omaha has far too many starting hands to sweep one by one like holdem, so
+# every seat of every deal counts towards its starting hand, up to suits. The
+# class of a hand relabels its suits in order of the values held in each (so
+# suits holding the same values, the only ones that could go either way, are
+# interchangeable) and codes the cards, highest first.
+#
+def omaha_classes(holes):
+    #
+    # Class code of each hand in holes, shape (hands, hole cards)
+    #
+    holes = np.asarray(holes, dtype=np.int64)
+    suits = holes & 3
+    suit_masks = ((suits[:, :, None] == np.arange(4)) * np_card_bits[holes][:, :, None]).sum(axis=1)
+    relabel = np.argsort(np.argsort(-suit_masks, axis=1, kind='stable'), axis=1)
+    relabelled = np.sort((holes & ~3) | np.take_along_axis(relabel, suits, axis=1), axis=1)[:, ::-1]
+    return (relabelled * (NUM_CARDS ** np.arange(holes.shape[-1]))).sum(axis=-1)
+
+def omaha_class_hand(code, num_hole):
+    return [int(code // NUM_CARDS ** i % NUM_CARDS) for i in range(num_hole)]
+
+OMAHA_BATCH = 2000
+OMAHA_CHUNK = 100000
+
+def run_omaha_chunk(task):
+    #
+    # Deal num_runs tables of num_players Omaha hands. Returns a dict of class
+    # code to counts for every seat dealt.
+    #
+    index, num_runs, num_players, num_hole, flop_only, batch_size, seed = task
+    rng = np.random.default_rng(seed)
+    field_size = 5 if not flop_only else 3
+    counts = {}
+    if not batch_size:
+        dealer = new_dealer((), rng)
+        for i in range(num_runs):
+            cards = deal_cards(dealer, num_players * num_hole + field_size)
+            holes = [cards[j * num_hole:(j + 1) * num_hole] for j in range(num_players)]
+            field = cards[num_players * num_hole:]
+            strengths = [best_omaha_strength(hole, field) for hole in holes]
+            max_strength = max(strengths)
+            split = strengths.count(max_strength) > 1
+            for code, strength in zip(omaha_classes(holes).tolist(), strengths):
+                hand_counts = counts.setdefault(code, new_counts())
+                hand_counts["trials"] += 1
+                if strength == max_strength:
+                    hand_counts["wins"] += 1
+                    hand_counts["ties"] += split
+                    hand_counts["ranks"][strength_rank(strength)] += 1
+        return counts
+
+    #
+    # Every seat's class, winning rank (-1 for a loss) and whether it split,
+    # tallied by class once the whole chunk is dealt
+    #
+    seat_codes = []
+    seat_ranks = []
+    seat_ties = []
+    done = 0
+    while done < num_runs:
+        n = min(batch_size, num_runs - done)
+        dealt = rng.random((n, NUM_CARDS)).argsort(axis=1)[:, :num_players * num_hole + field_size]
+        holes = dealt[:, :num_players * num_hole].reshape(n, num_players, num_hole)
+        strengths = omaha_batch_strengths(holes, dealt[:, num_players * num_hole:])
+        won = strengths == strengths.max(axis=1)[:, None]
+        seat_codes.append(omaha_classes(holes.reshape(-1, num_hole)))
+        seat_ranks.append(np.where(won, strengths >> STRENGTH_SHIFT, -1).ravel())
+        seat_ties.append((won & (won.sum(axis=1) > 1)[:, None]).ravel())
+        done += n
+    if not seat_codes:
+        return counts
+
+    codes, seats = np.unique(np.concatenate(seat_codes), return_inverse=True)
+    ranks = np.concatenate(seat_ranks)
+    won = ranks >= 0
+    trials = np.bincount(seats, minlength=len(codes))
+    wins = np.bincount(seats[won], minlength=len(codes))
+    ties = np.bincount(seats[np.concatenate(seat_ties)], minlength=len(codes))
+    winning_ranks = np.bincount(seats[won] * 9 + ranks[won], minlength=len(codes) * 9).reshape(-1, 9)
+    for i, code in enumerate(codes.tolist()):
+        counts[code] = {"trials": int(trials[i]), "wins": int(wins[i]), "ties": int(ties[i]),
+            "ranks": winning_ranks[i].tolist()}
+    return counts
+
+def run_omaha_sim(num_runs, num_players, num_hole = 4, flop_only = False, batch_size = None, workers = 1, seed = None):
+    #
+    # Omaha (num_hole of 4 or 5) over num_runs deals. Every seat counts for
+    # its starting hand class, so results are [ev, hand, counts] per class
+    # dealt, with hand the class's cards in one suit labelling. Deals are
+    # split into fixed chunks with their own streams.
+    #
+    # There are far more classes than deals at most --runs, so many are only
+    # seen a few times. They are sorted by the low end of their confidence
+    # interval, which a class won once out of once doesn't top.
+    #
+    tasks = [(k, min(OMAHA_CHUNK, num_runs - start), num_players, num_hole, flop_only, batch_size,
+        np.random.SeedSequence(seed, spawn_key=(k,))) for k, start in enumerate(range(0, num_runs, OMAHA_CHUNK))]
+    counts = {}
+    with worker_pool(workers) as pool:
+        for more in map_tasks(run_omaha_chunk, tasks, pool):
+            for code, hand_counts in more.items():
+                merge_counts(counts.setdefault(code, new_counts()), hand_counts)
+
+    hands = []
+    for code, hand_counts in counts.items():
+        hands.append([float(hand_counts["wins"])/float(hand_counts["trials"]), omaha_class_hand(code, num_hole), hand_counts])
+    return sorted(hands, key=lambda hand: (confidence_interval(hand[2])[0], hand[0]), reverse=True)
+
+def hand_seed(seed, index, chunk = None):
+    #
+    # Each starting hand gets its own random stream, derived from the sweep seed
+    # and its index, so results don't depend on which worker ran it or when.
+    # Hands sampled in several chunks get a stream per chunk.
+    #
+    spawn_key = (index,) if not chunk else (index, chunk)
+    return np.random.SeedSequence(seed, spawn_key=spawn_key)
+
+def get_rng_state(rng):
+    #
+    # JSON friendly state of a random.Random, NumPy Generator or dealer
+    #
+    if isinstance(rng, dict):
+        return {"dealer": {"deck": list(rng["deck"]), "randoms": rng["randoms"][rng["next"]:],
+            "rng": get_rng_state(rng["rng"])}}
+    if isinstance(rng, np.random.Generator):
+        return {"numpy": rng.bit_generator.state}
+    version, internal, gauss = rng.getstate()
+    return {"python": [version, list(internal), gauss]}
+
+def set_rng_state(rng, state):
+    if "dealer" in state:
+        rng["deck"] = list(state["dealer"]["deck"])
+        rng["randoms"] = list(state["dealer"]["randoms"])
+        rng["next"] = 0
+        set_rng_state(rng["rng"], state["dealer"]["rng"])
+    elif "numpy" in state:
+        rng.bit_generator.state = state["numpy"]
+    else:
+        version, internal, gauss = state["python"]
+        rng.setstate((version, tuple(internal), gauss))
+
+PROGRESS_EVERY = 1000
+
+def run_hold_em_hand_sim(num_hands, num_players, test_hand, flop_only = False, batch_size = None, seed = None,
+        progress = None, resume = None):
+    #
+    # seed is anything np.random.SeedSequence accepts, or a SeedSequence. Without
+    # one, the random streams are seeded fresh.
+    #
+    # progress(counts, rng) is called every so often with the counts so far.
+    # resume is a (counts, rng state) pair saved from it, to carry on exactly
+    # where that left off.
+    #
+    if seed is not None and not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    counts = new_counts()
+    if batch_size:
+        rng = np.random.default_rng(seed)
+        if resume is not None:
+            counts = resume[0]
+            set_rng_state(rng, resume[1])
+        counts = run_hold_em_batch(num_hands, num_players, test_hand, flop_only, batch_size, rng, counts, progress)
+    else:
+        dealer = new_dealer(test_hand, np.random.default_rng(seed))
+        if resume is not None:
+            counts = resume[0]
+            set_rng_state(dealer, resume[1])
+        for i in range(counts["trials"], num_hands): 
+            if verbose and i % 100 == 0:
+                print("Running hand %d" % i)
+            hole_winners, strength = run_hold_em_hand(num_players - 1, test_hand, flop_only, dealer=dealer)
+            count_hand(counts, test_hand, hole_winners, strength)
+            if counts["trials"] % PROGRESS_EVERY == 0:
+                #
+                # Drop the unused random numbers here whether or not anyone is
+                # watching, so a checkpoint stays small and a resumed run
+                # deals the same cards as one that never stopped
+                #
+                dealer["randoms"] = []
+                if progress is not None:
+                    progress(counts, dealer)
 
     if debug:
-        print("%s won %.1f%%" % (format_hand(test_hand), float(wins)/float(num_hands) * 100.0))
-        for i in range(len(winning_rank)):
-                print("%s: %d" % (format_rank(i), winning_rank[i]))
-    return wins
+        print("%s won %.1f%%" % (format_hand(test_hand), float(counts["wins"])/float(num_hands) * 100.0))
+        for i in range(len(counts["ranks"])):
+                print("%s: %d" % (format_rank(i), counts["ranks"][i]))
+    return counts
             
-def run_hold_em_sim(num_hands, num_players, flop_only):
+def get_starting_hands():
     #
     # Stick with two suits. This will give us suited and non-suited with fewer starting possibilities
     #
     suits = [DIAMONDS, HEARTS]
 
-    deck = []
-    for card in card_values:
-        for suit in suits:
-            deck.append((card, suit))
+    deck = [make_card(value, suit) for value in card_values for suit in suits]
 
     potential_hands = list(itertools.combinations(deck, 2))
     test_hands = []
@@ -428,38 +1866,627 @@ def run_hold_em_sim(num_hands, num_players, flop_only):
     # Hold 'em hands
     #
     for hand in potential_hands:
-        if hand[0][0] == hand[1][0]:
-            test_hands.append(hand) 
-        elif hand[0][1] == DIAMONDS and hand[1][1] == HEARTS:
-            test_hands.append(hand)
-        elif hand[0][1] == DIAMONDS and hand[1][1] == DIAMONDS:
-            test_hands.append(hand)
+        if get_value(hand[0]) == get_value(hand[1]):
+            test_hands.append(list(hand)) 
+        elif get_suit(hand[0]) == DIAMONDS and get_suit(hand[1]) == HEARTS:
+            test_hands.append(list(hand))
+        elif get_suit(hand[0]) == DIAMONDS and get_suit(hand[1]) == DIAMONDS:
+            test_hands.append(list(hand))
+    return test_hands
+
+def run_starting_hand(task, progress = None, resume = None):
+    #
+    # One starting hand of run_hold_em_sim. Takes a single tuple so it can be
+    # handed to a process pool.
+    #
+    # Returns the index, the counts, and the stage stats for this hand when
+    # they are being collected, so workers can hand them back to be merged.
+    #
+    global stage_stats
+    index, test_hand, num_hands, num_players, flop_only, batch_size, seed, exact = task
+    if verbose:
+        print("testing %s" % format_hand(test_hand))
+
+    outer_stats = stage_stats
+    if outer_stats is not None:
+        stage_stats = new_stats()
+        start = time.perf_counter()
+        if eval_cache is not None:
+            hits, misses = eval_cache["hits"], eval_cache["misses"]
+    try:
+        if exact:
+            counts = exact_hold_em_hand(test_hand, flop_only)
+        else:
+            counts = run_hold_em_hand_sim(num_hands, num_players, test_hand, flop_only, batch_size, seed, progress, resume)
+    finally:
+        hand_stats = stage_stats
+        stage_stats = outer_stats
+
+    if hand_stats is not None:
+        seconds = time.perf_counter() - start
+        hand_stats["starting_hands"][format_holdem_hand_for_graph(test_hand)] = {
+            "trials": counts["trials"], "seconds": seconds, "hands_per_sec": counts["trials"] / seconds if seconds else 0.0
+        }
+        if eval_cache is not None:
+            hand_stats["counters"]["cache_hits"] += eval_cache["hits"] - hits
+            hand_stats["counters"]["cache_misses"] += eval_cache["misses"] - misses
+    if verbose:
+        print("%s won %.2f%%" % (format_hand(test_hand), (float(counts["wins"])/float(counts["trials"])) * 100.0))
+    return index, counts, hand_stats
+
+def add_stats(hand_stats):
+    #
+    # Fold the stats a starting hand came back with into the running total
+    #
+    global stage_stats
+    if hand_stats is not None:
+        if stage_stats is None:
+            stage_stats = new_stats()
+        merge_stats(stage_stats, hand_stats)
+
+@contextlib.contextmanager
+def worker_pool(workers):
+    #
+    # A process pool of workers processes (0 for one per core), or None to
+    # run in process when workers is 1. Closed when the block is done, and
+    # terminated if it is left early, so nothing waits on tasks still queued.
+    # Every task carries its own seed (see hand_seed), so seeded results
+    # don't depend on the number of workers.
+    #
+    if workers == 1:
+        yield None
+        return
+    pool = multiprocessing.Pool(workers or os.cpu_count())
+    try:
+        yield pool
+    except BaseException:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
+def map_tasks(fn, tasks, pool = None, chunksize = 1):
+    #
+    # fn over tasks, in the order they finish on pool or in order without one
+    #
+    if pool is None:
+        return map(fn, tasks)
+    return pool.imap_unordered(fn, tasks, chunksize)
 
-    hands = []
-    for test_hand in test_hands:
-        test_hand = list(test_hand)
+CI_FIRST_ROUND = 1000
+
+def is_separated(index, results, counts):
+    #
+    # True if the interval of hand index doesn't overlap those of the hands
+    # either side of it in the current ranking, so more samples won't move it
+    #
+    ranking = sorted(range(len(results)), key=lambda i: results[i], reverse=True)
+    position = ranking.index(index)
+    low, high = confidence_interval(counts[index])
+    if position > 0 and high >= confidence_interval(counts[ranking[position - 1]])[0]:
+        return False
+    if position < len(ranking) - 1 and low <= confidence_interval(counts[ranking[position + 1]])[1]:
+        return False
+    return True
+
+def run_adaptive_sweep(test_hands, counts, chunks, max_hands, num_players, flop_only, batch_size, seed, ci, pool = None,
+        active = None, on_round = None):
+    #
+    # Sample every starting hand in rounds until its interval is within ci
+    # either side, it is clearly separated from its neighbours in the
+    # ranking, or it has had max_hands samples. Adds to counts and chunks
+    # in place, calling on_round(active) after every round. A generator:
+    # after every round, yields (index, finished) for each hand sampled in
+    # it, finished once the hand is done sampling.
+    #
+    if active is None:
+        active = [i for i in range(len(test_hands)) if counts[i]["trials"] < max_hands]
+    round = 0
+    while active:
+        tasks = []
+        for i in active:
+            trials = counts[i]["trials"]
+            if trials:
+                p = float(counts[i]["wins"]) / trials
+                needed = int(CI_Z * CI_Z * p * (1 - p) / (ci * ci)) + 1 - trials
+            else:
+                needed = CI_FIRST_ROUND
+            n = min(max(needed, CI_FIRST_ROUND), max_hands - trials)
+            tasks.append((i, test_hands[i], n, num_players, flop_only, batch_size, hand_seed(seed, i, chunks[i]), False))
+
+        for i, more, hand_stats in map_tasks(run_starting_hand, tasks, pool):
+            add_stats(hand_stats)
+            merge_counts(counts[i], more)
+            chunks[i] += 1
+        round += 1
+
+        results = [float(c["wins"]) / c["trials"] if c["trials"] else 0.0 for c in counts]
+        still_active = []
+        for i in active:
+            low, high = confidence_interval(counts[i])
+            if counts[i]["trials"] >= max_hands or (high - low) / 2 <= ci or is_separated(i, results, counts):
+                continue
+            still_active.append(i)
         if verbose:
-            print("testing %s" % format_hand(test_hand))
-        wins = run_hold_em_hand_sim(num_hands, num_players, test_hand, flop_only)
+            print("round %d: %d hands still sampling" % (round, len(still_active)))
+        if on_round is not None:
+            on_round(still_active)
+        for i in active:
+            yield i, i not in still_active
+        active = still_active
+
+def each_keys(each, num_players):
+    #
+    # What run_hold_em_each_sim splits its results by: the street names, or
+    # the number of players at each table size
+    #
+    if each == "streets":
+        return [street for street, field_size in STREETS]
+    return list(range(2, num_players + 1))
+
+def run_starting_hand_each(task):
+    #
+    # run_starting_hand for run_hold_em_each_sim. Returns the index and a
+    # list of counts, in the order of each_keys.
+    #
+    index, test_hand, each, num_hands, num_players, flop_only, batch_size, seed = task
+    if verbose:
+        print("testing %s" % format_hand(test_hand))
+    rng = np.random.default_rng(seed)
+    if batch_size:
+        if each == "streets":
+            return index, run_hold_em_streets_batch(num_hands, num_players, test_hand, batch_size, rng)
+        return index, run_hold_em_sizes_batch(num_hands, num_players, test_hand, flop_only, batch_size, rng)
+
+    dealer = new_dealer(test_hand, rng)
+    counts = [new_counts() for key in each_keys(each, num_players)]
+    for i in range(num_hands):
+        if verbose and i % 100 == 0:
+            print("Running hand %d" % i)
+        if each == "streets":
+            showdowns = run_hold_em_streets_hand(num_players - 1, test_hand, dealer=dealer)
+        else:
+            showdowns = run_hold_em_sizes_hand(num_players - 1, test_hand, flop_only, dealer=dealer)
+        for key_counts, (hole_winners, strength) in zip(counts, showdowns):
+            count_hand(key_counts, test_hand, hole_winners, strength)
+    return index, counts
+
+def run_hold_em_each_sim(each, num_hands, num_players, flop_only, batch_size = None, workers = 1, seed = None):
+    #
+    # run_hold_em_sim for several results read off the same deals. each is
+    # "streets" to score every deal at the flop, turn and river (flop_only is
+    # ignored), or "sizes" to deal num_players players and read off every
+    # table size from 2 players up. Returns a dict of each_keys to results,
+    # sorted like run_hold_em_sim's.
+    #
+    test_hands = get_starting_hands()
+    tasks = [(i, test_hand, each, num_hands, num_players, flop_only, batch_size, hand_seed(seed, i))
+        for i, test_hand in enumerate(test_hands)]
+    counts = [None] * len(test_hands)
+
+    with worker_pool(workers) as pool:
+        for i, hand_counts in map_tasks(run_starting_hand_each, tasks, pool):
+            counts[i] = hand_counts
+
+    hands = {}
+    for k, key in enumerate(each_keys(each, num_players)):
+        hands[key] = sorted([[float(counts[i][k]["wins"])/float(counts[i][k]["trials"]), test_hand, counts[i][k]]
+            for i, test_hand in enumerate(test_hands)], reverse=True)
+    return hands
+
+SHARED_BATCH = 500
+SHARED_CHUNK = 20000
+
+def run_shared_scenarios(task):
+    #
+    # Deal num_scenarios boards and opponent hands from the full deck and play
+    # every starting hand against each one whose cards it doesn't collide
+    # with. The opponents are scored once per scenario, not once per starting
+    # hand. Returns the index and the counts of each starting hand, in the
+    # order of get_starting_hands.
+    #
+    index, num_scenarios, num_players, flop_only, batch_size, seed = task
+    rng = np.random.default_rng(seed)
+    test_hands = np.array(get_starting_hands(), dtype=np.int64)
+    field_size = 5 if not flop_only else 3
+    num_dealt = 2 * (num_players - 1) + field_size
+
+    trials = np.zeros(len(test_hands), dtype=np.int64)
+    wins = np.zeros(len(test_hands), dtype=np.int64)
+    ties = np.zeros(len(test_hands), dtype=np.int64)
+    winning_rank = np.zeros((len(test_hands), 9), dtype=np.int64)
+    done = 0
+    while done < num_scenarios:
+        n = min(batch_size, num_scenarios - done)
+        dealt = rng.random((n, NUM_CARDS)).argsort(axis=1)[:, :num_dealt]
+        holes = dealt[:, :2 * (num_players - 1)].reshape(n, num_players - 1, 2)
+        field = dealt[:, 2 * (num_players - 1):]
+        opponent_best = batch_strengths(np.concatenate(
+            [holes, np.broadcast_to(field[:, None, :], (n, num_players - 1, field_size))], axis=2)).max(axis=1)
+
+        used = np.zeros((n, NUM_CARDS), dtype=bool)
+        used[np.arange(n)[:, None], dealt] = True
+        rows, hands = np.nonzero(~(used[:, test_hands[:, 0]] | used[:, test_hands[:, 1]]))
+        strengths = batch_strengths(np.concatenate([test_hands[hands], field[rows]], axis=1))
+
+        won = strengths >= opponent_best[rows]
+        trials += np.bincount(hands, minlength=len(test_hands))
+        wins += np.bincount(hands[won], minlength=len(test_hands))
+        ties += np.bincount(hands[strengths == opponent_best[rows]], minlength=len(test_hands))
+        np.add.at(winning_rank, (hands[won], strengths[won] >> STRENGTH_SHIFT), 1)
+        done += n
+
+    counts = []
+    for i in range(len(test_hands)):
+        counts.append({"trials": int(trials[i]), "wins": int(wins[i]), "ties": int(ties[i]),
+            "ranks": [int(count) for count in winning_rank[i]]})
+    return index, counts
+
+def run_shared_sim(num_hands, num_players, flop_only, batch_size = None, workers = 1, seed = None):
+    #
+    # run_hold_em_sim with common random numbers: every starting hand is
+    # played against the same scenarios (see run_shared_scenarios), so the
+    # differences between hands aren't buried under independent deals. Deals
+    # until every hand has seen at least num_hands scenarios it fits in.
+    # Scenarios are split into fixed chunks with their own streams.
+    #
+    test_hands = get_starting_hands()
+    counts = [new_counts() for test_hand in test_hands]
+    num_dealt = 2 * (num_players - 1) + (5 if not flop_only else 3)
+    live_rate = (NUM_CARDS - num_dealt) * (NUM_CARDS - num_dealt - 1) / float(NUM_CARDS * (NUM_CARDS - 1))
+
+    with worker_pool(workers) as pool:
+        round_number = 0
+        while True:
+            short = num_hands - min([hand_counts["trials"] for hand_counts in counts])
+            if short <= 0:
+                break
+            scenarios = int(short / live_rate) + 1
+            if verbose:
+                print("dealing %d scenarios" % scenarios)
+            tasks = [(k, min(SHARED_CHUNK, scenarios - start), num_players, flop_only, batch_size or SHARED_BATCH,
+                np.random.SeedSequence(seed, spawn_key=(round_number, k))) for k, start in enumerate(range(0, scenarios, SHARED_CHUNK))]
+            for k, more in map_tasks(run_shared_scenarios, tasks, pool):
+                for hand_counts, hand_more in zip(counts, more):
+                    merge_counts(hand_counts, hand_more)
+            round_number += 1
+
+    hands = []
+    for i, test_hand in enumerate(test_hands):
+        hands.append([float(counts[i]["wins"])/float(counts[i]["trials"]), test_hand, counts[i]])
+    return sorted(hands, reverse=True)
+
+def run_hold_em_shard(num_hands, num_players, flop_only, shard, num_shards, num_chunks = 1, batch_size = None,
+        workers = 1, seed = None, exact = False):
+    #
+    # One shard of a sweep, so a big one can be split over machines. Each
+    # starting hand's runs are cut into num_chunks chunks and the (hand, chunk)
+    # pairs are dealt round robin over the shards; shard is 0 based. Chunk c of
+    # hand i samples from hand_seed(seed, i, c), which no other shard uses, and
+    # with one chunk the shards between them repeat the unsharded seeded run.
+    # Exact sweeps can't be chunked, so their hands alone are dealt round robin.
+    #
+    # Returns results like run_hold_em_sim's for the hands this shard touched,
+    # for write_results and later merge_results.
+    #
+    test_hands = get_starting_hands()
+    tasks = []
+    for i, test_hand in enumerate(test_hands):
+        for chunk in range(num_chunks if not exact else 1):
+            if (i if exact else i * num_chunks + chunk) % num_shards != shard:
+                continue
+            n = num_hands // num_chunks + (1 if chunk < num_hands % num_chunks else 0) if not exact else None
+            if n == 0:
+                continue
+            tasks.append((i, test_hand, n, num_players, flop_only, batch_size, hand_seed(seed, i, chunk), exact))
+
+    counts = {}
+    with worker_pool(workers) as pool:
+        for i, more, hand_stats in map_tasks(run_starting_hand, tasks, pool):
+            add_stats(hand_stats)
+            merge_counts(counts.setdefault(i, new_counts()), more)
+
+    hands = []
+    for i in sorted(counts):
+        hands.append([float(counts[i]["wins"])/float(counts[i]["trials"]), test_hands[i], counts[i]])
+    return sorted(hands, reverse=True)
+
+def store_key(test_hand, num_players, flop_only, exact = False):
+    return "%s %d %s%s" % (format_holdem_hand_for_graph(test_hand), num_players,
+        "flop" if flop_only else "river", " exact" if exact else "")
+
+CHECKPOINT_SECONDS = 60.0
+
+def iter_hold_em_sim(num_hands, num_players, flop_only, batch_size = None, workers = 1, seed = None, exact = False,
+        ci = None, store = None, checkpoint = None, resume = False):
+    #
+    # run_hold_em_sim as a generator, yielding (index, starting hand, counts,
+    # finished) as the sweep goes rather than waiting for all 169 hands.
+    # Every hand is yielded finished exactly once: hands already done (in the
+    # store, or before a resumed run stopped) first, then each as it
+    # completes. With ci, hands still sampling are also yielded unfinished
+    # after every round. counts are the sweep's own, updated in place.
+    #
+    # store is a dict of earlier results (see load_store). Hands already in it
+    # are only sampled up to num_hands, and the merged counts are put back
+    # once the sweep is done.
+    #
+    # checkpoint is a file the progress is saved to as hands finish, and every
+    # CHECKPOINT_SECONDS for the hand being sampled when running in process.
+    # With resume, carry on from it; the results are the same as if the run had
+    # never stopped. The file is removed once the sweep is done.
+    #
+    test_hands = get_starting_hands()
+    keys = [store_key(test_hand, num_players, flop_only, exact) for test_hand in test_hands]
+
+    #
+    # chunks counts the separately seeded runs each hand has had, so a top up
+    # never replays a stream that is already in the counts
+    #
+    counts = [new_counts() for test_hand in test_hands]
+    chunks = [0] * len(test_hands)
+    if store is not None:
+        for i, key in enumerate(keys):
+            if key in store:
+                counts[i] = store[key]["counts"]
+                chunks[i] = store[key]["chunks"]
+
+    #
+    # Without a seed, draw one from the OS so the starting hands still get
+    # independent streams in every worker
+    #
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    run = {
+        "num_hands": num_hands, "num_players": num_players, "flop_only": flop_only,
+        "batch_size": batch_size, "exact": exact, "ci": ci
+    }
+    state = {"run": run, "seed": seed, "counts": counts, "chunks": chunks, "done": [], "active": None, "partial": None}
+    if resume and checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint, 'r') as f:
+            state = json.load(f)
+        if state["run"] != run:
+            raise ValueError("checkpoint %s is from a different run" % checkpoint)
+        seed = state["seed"]
+        counts = state["counts"]
+        chunks = state["chunks"]
         if verbose:
-            print("%s won %.2f%%" % (format_hand(test_hand), (float(wins)/float(num_hands)) * 100.0))
-        hands.append([float(wins)/float(num_hands),test_hand])
-    hands = sorted(hands, reverse=True)    
-    
-    return(hands)
+            print("resuming from %s, %d hands done" % (checkpoint, len(state["done"])))
+
+    last_save = [time.time()]
+    def save_checkpoint(force = True):
+        if checkpoint and (force or time.time() - last_save[0] >= CHECKPOINT_SECONDS):
+            write_json(checkpoint, state)
+            last_save[0] = time.time()
+
+    #
+    # The hands that still need sampling
+    #
+    adaptive = ci and not exact
+    tasks = []
+    if adaptive:
+        active = state["active"]
+        if active is None:
+            active = [i for i in range(len(test_hands)) if counts[i]["trials"] < num_hands]
+        pending = set(active)
+    else:
+        for i, test_hand in enumerate(test_hands):
+            if i in state["done"] or (exact and counts[i]["trials"]):
+                continue
+            n = num_hands - counts[i]["trials"] if not exact else None
+            if n is not None and n <= 0:
+                continue
+            tasks.append((i, test_hand, n, num_players, flop_only, batch_size, hand_seed(seed, i, chunks[i]), exact))
+        pending = set([task[0] for task in tasks])
+    for i, test_hand in enumerate(test_hands):
+        if i not in pending:
+            yield i, test_hand, counts[i], True
+
+    #
+    # A sweep given up on part way doesn't wait for the hands still queued
+    #
+    with worker_pool(workers) as pool:
+        if adaptive:
+            def on_round(active):
+                state["active"] = active
+                save_checkpoint()
+            for i, finished in run_adaptive_sweep(test_hands, counts, chunks, num_hands, num_players, flop_only,
+                    batch_size, seed, ci, pool, active, on_round):
+                yield i, test_hands[i], counts[i], finished
+        else:
+            def finish(i, more, hand_stats):
+                add_stats(hand_stats)
+                merge_counts(counts[i], more)
+                chunks[i] += 1
+                state["done"].append(i)
+                state["partial"] = None
+                save_checkpoint()
+
+            if pool is None:
+                for task in tasks:
+                    i = task[0]
+                    def progress(partial, rng):
+                        state["partial"] = {"index": i, "counts": partial, "rng": get_rng_state(rng)}
+                        save_checkpoint(False)
+                    resume_hand = None
+                    if state["partial"] is not None and state["partial"]["index"] == i:
+                        resume_hand = (state["partial"]["counts"], state["partial"]["rng"])
+                    finish(*run_starting_hand(task, progress, resume_hand))
+                    yield i, test_hands[i], counts[i], True
+            else:
+                for i, more, hand_stats in map_tasks(run_starting_hand, tasks, pool):
+                    finish(i, more, hand_stats)
+                    yield i, test_hands[i], counts[i], True
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    if store is not None:
+        for i, key in enumerate(keys):
+            store[key] = {"counts": counts[i], "chunks": chunks[i]}
+
+def run_hold_em_sim(num_hands, num_players, flop_only, batch_size = None, workers = 1, seed = None, exact = False, ci = None,
+        store = None, checkpoint = None, resume = False):
+    #
+    # Returns [EV, starting hand, counts] for each starting hand, best first.
+    # With exact, num_players must be 2 and num_hands is ignored. With ci,
+    # num_hands is the most samples any one hand gets. See iter_hold_em_sim
+    # for store, checkpoint and resume.
+    #
+    hands = []
+    for i, test_hand, counts, finished in iter_hold_em_sim(num_hands, num_players, flop_only, batch_size, workers, seed,
+            exact, ci, store, checkpoint, resume):
+        if finished:
+            hands.append([float(counts["wins"])/float(counts["trials"]), test_hand, counts])
+    return sorted(hands, reverse=True)
+
+def load_store(fname):
+    #
+    # The results store is a JSON dict of store_key to raw counts, so runs
+    # can be combined. A missing file is an empty store.
+    #
+    if not os.path.exists(fname):
+        return {}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+def write_json(fname, data):
+    #
+    # Write to the side and rename, so a crash never leaves half a file
+    #
+    with open(fname + ".tmp", 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(fname + ".tmp", fname)
+
+def save_store(fname, store):
+    write_json(fname, store)
+
+def read_store(fname, num_players, flop_only, exact = False):
+    store = load_store(fname)
+    hand_results = []
+    for test_hand in get_starting_hands():
+        key = store_key(test_hand, num_players, flop_only, exact)
+        if key in store:
+            counts = store[key]["counts"]
+            hand_results.append([float(counts["wins"])/float(counts["trials"]), test_hand, counts])
+    return sorted(hand_results, reverse=True)
+
+EQUITY_MATRIX_FILE = "holdem_equity_matrix.npy"
+
+def hand_class(hand):
+    #
+    # (high value, low value, suited) for two hole cards
+    #
+    values = sorted([get_value(card) for card in hand], reverse=True)
+    return values[0], values[1], get_suit(hand[0]) == get_suit(hand[1])
+
+def class_range(hand):
+    #
+    # Every combo of hand's starting hand, e.g. all 4 A,Ks or all 6 10,10
+    #
+    high, low, suited = hand_class(hand)
+    return hand_class_combos(high, low, '' if high == low else 's' if suited else 'o')
+
+def run_matchup(task):
+    #
+    # One cell of the equity matrix. Returns win, tie and loss fractions for
+    # the first hand, with combos dealt evenly over the pairs that don't
+    # share a card.
+    #
+    i, j, test_hand, other_hand, num_hands, batch_size, seed = task
+    counts = range_equity(class_range(test_hand), [class_range(other_hand)], num_hands, False, batch_size, seed)
+    trials = float(counts["trials"])
+    win = (counts["wins"] - counts["ties"]) / trials
+    tie = counts["ties"] / trials
+    return i, j, (win, tie, 1.0 - win - tie)
+
+def build_equity_matrix(fname, num_hands, batch_size = 10000, workers = 1, seed = None):
+    #
+    # Heads up win, tie and loss for every pair of starting hands, in the order
+    # of get_starting_hands, sampled num_hands times each. Saved as a
+    # 169x169x3 float32 .npy so load_equity_matrix can map it.
+    #
+    test_hands = get_starting_hands()
+    matrix = np.zeros((len(test_hands), len(test_hands), 3), dtype=np.float32)
+    tasks = []
+    for i in range(len(test_hands)):
+        for j in range(i, len(test_hands)):
+            tasks.append((i, j, test_hands[i], test_hands[j], num_hands, batch_size,
+                np.random.SeedSequence(seed, spawn_key=(i, j))))
+
+    with worker_pool(workers) as pool:
+        for done, (i, j, (win, tie, loss)) in enumerate(map_tasks(run_matchup, tasks, pool, 64)):
+            if verbose and done % 1000 == 0:
+                print("%d of %d matchups" % (done, len(tasks)))
+            matrix[i, j] = (win, tie, loss)
+            matrix[j, i] = (loss, tie, win)
+
+    with open(fname + ".tmp", 'wb') as f:
+        np.save(f, matrix)
+    os.replace(fname + ".tmp", fname)
+    return matrix
+
+equity_matrices = {}
+starting_hand_index = {}
+
+def load_equity_matrix(fname = EQUITY_MATRIX_FILE):
+    #
+    # Memory mapped, so lookups only touch the pages they need and every
+    # process reading the file shares them. Kept open after the first call.
+    #
+    if fname not in equity_matrices:
+        equity_matrices[fname] = np.load(fname, mmap_mode='r')
+    return equity_matrices[fname]
+
+def parse_starting_hand(text):
+    #
+    # Two hole cards of the starting hand in text, "A,Ks" or "AKs" style
+    #
+    text = text.strip()
+    if ',' in text:
+        try:
+            hand = parse_holdem_hand(text)
+        except (ValueError, IndexError):
+            raise ValueError("bad starting hand: %s" % text)
+        if hand[0] == hand[1]:
+            raise ValueError("a pair can't be suited: %s" % text)
+        return hand
+    high, low, kind = parse_hand_class(text)
+    if high != low and not kind:
+        raise ValueError("say whether %s is suited (s) or offsuit (o)" % text)
+    return [make_card(high, DIAMONDS), make_card(low, DIAMONDS if kind == 's' else HEARTS)]
+
+def matchup_equity(hand, other_hand, fname = EQUITY_MATRIX_FILE):
+    #
+    # (win, tie, loss) for hand against other_hand heads up, from the matrix
+    # build_equity_matrix wrote. Hands are cards, or strings parse_starting_hand
+    # takes.
+    #
+    if not starting_hand_index:
+        for i, test_hand in enumerate(get_starting_hands()):
+            starting_hand_index[hand_class(test_hand)] = i
+    if isinstance(hand, str):
+        hand = parse_starting_hand(hand)
+    if isinstance(other_hand, str):
+        other_hand = parse_starting_hand(other_hand)
+    win, tie, loss = load_equity_matrix(fname)[starting_hand_index[hand_class(hand)], starting_hand_index[hand_class(other_hand)]]
+    return float(win), float(tie), float(loss)
 
 def test_winners():
     hands =[
         [(2, 'h'), (2, 'd'), (4, 'h'), (4, 'd'), (KING, 'h')],
         [(2, 'd'), (2, 'h'), (4, 'd'), (4, 'h'), (ACE, 'd')]
     ]
-    print(get_winners(hands))
+    hands = [[make_card(value, suit) for value, suit in hand] for hand in hands]
+    print([format_hand(hand) for hand in get_winners(hands)])
 
 def split_results(results, threshold):
     rest = results
     # 
     # Results are a list of [result percentage, hand], where hand is a list
-    # [card 1, card 2]. Each card is a tuple, (value, suit).
+    # [card 1, card 2]. Each card is an int, see make_card.
     # 
     pairs = []    
     suited_consecutive = []
@@ -470,7 +2497,7 @@ def split_results(results, threshold):
     #
     pairs = [
         result for result in results 
-        if result[1][0][0] == result[1][1][0]
+        if get_value(result[1][0]) == get_value(result[1][1])
     ]
     rest = [result for result in results if result not in pairs]
     #
@@ -478,8 +2505,8 @@ def split_results(results, threshold):
     #
     suited_consecutive = [
         result for result in rest 
-        if result[1][0][1] == result[1][1][1]
-        and (result[1][1][0] - result[1][0][0] == 1 or (result[1][1][0] == ACE and result[1][0][0] == 2))
+        if get_suit(result[1][0]) == get_suit(result[1][1])
+        and (get_value(result[1][1]) - get_value(result[1][0]) == 1 or (get_value(result[1][1]) == ACE and get_value(result[1][0]) == 2))
     ]
     rest = [result for result in rest if result[0] > threshold and result not in suited_consecutive]
     #
@@ -487,8 +2514,8 @@ def split_results(results, threshold):
     #
     suited_connectors = [
         result for result in rest 
-        if result[1][0][1] == result[1][1][1]
-        and (result[1][1][0] - result[1][0][0] < 5 or (result[1][1][0] == ACE and result[1][0][0] in [5, 4, 3]))
+        if get_suit(result[1][0]) == get_suit(result[1][1])
+        and (get_value(result[1][1]) - get_value(result[1][0]) < 5 or (get_value(result[1][1]) == ACE and get_value(result[1][0]) in [5, 4, 3]))
     ]
     #
     # 'Field' hands over threshold
@@ -505,6 +2532,11 @@ def split_results(results, threshold):
     return ret
 
 def graph(hand_results, threshold, top_10_ev, top_20_ev):
+    #
+    # matplotlib is slow to import and only needed here
+    #
+    import matplotlib.pyplot as plt
+
     num_rows = len(hand_results)
     fig, subplots = plt.subplots(num_rows, 1)
     fig.suptitle('Hold ''em Hand Results -- EV > %.1f%%' % (threshold * 100.0))
@@ -548,36 +2580,280 @@ def graph(hand_results, threshold, top_10_ev, top_20_ev):
     # Show graphic
     plt.show()
 
+def csv_row(hand):
+    #
+    # hand, EV, tie rate, EV confidence interval low and high, samples. Hands
+    # of more than 2 cards (omaha) are written out card by card.
+    #
+    counts = hand[2]
+    low, high = confidence_interval(counts)
+    label = format_holdem_hand_for_graph(hand[1]) if len(hand[1]) == 2 else format_hand(hand[1])
+    return "\"%s\", %f, %f, %f, %f, %d\n" % (label, hand[0],
+        float(counts["ties"])/float(counts["trials"]), low, high, counts["trials"])
+
+def write_csv(fname, hand_results):
+    with open(fname, 'w') as f:
+        for hand in hand_results:
+            f.write(csv_row(hand))
+
+def parse_holdem_hand(hand_value):
+    #
+    # Inverse of format_holdem_hand_for_graph, e.g. "A,Ks" or "10,10"
+    #
+    suited = 's' in hand_value
+    if suited:
+        hand_value = hand_value.replace('s', '')
+
+    card_values = hand_value.split(',')
+    new_values = []
+    for card_value in card_values:
+        card_value = card_value.strip()
+        if card_value == 'J':
+            card_value = JACK
+        elif card_value == 'Q':
+            card_value = QUEEN
+        elif card_value == 'K':
+            card_value = KING
+        elif card_value == 'A':
+            card_value = ACE
+        else:
+            card_value = int(card_value)
+        new_values.append(card_value)
+    return [make_card(new_values[0], DIAMONDS), make_card(new_values[1], DIAMONDS if suited else HEARTS)]
+
 def read_csv(fname):
+    #
+    # Best first, since a sweep still running (or killed) has only written
+    # the hands done so far, in the order they finished
+    #
     hand_results = []
     with open(fname, 'r') as f:
         reader = csv.reader(f)
         for row in reader:
             hand_ev = float(row[1])                    
-            hand_value = row[0]
-            
-            suited = 's' in hand_value
-            if suited:
-                hand_value = hand_value.replace('s', '')
-
-            card_values = hand_value.split(',')
-            new_values = []
-            for card_value in card_values:
-                if card_value == 'J':
-                    card_value = JACK
-                elif card_value == 'Q':
-                    card_value = QUEEN
-                elif card_value == 'K':
-                    card_value = KING
-                elif card_value == 'A':
-                    card_value = ACE
-                else:
-                    card_value = int(card_value)
-                new_values.append(card_value)
-            
-            v = [hand_ev, [(new_values[0], DIAMONDS), (new_values[1], DIAMONDS if suited else HEARTS)]]
+            v = [hand_ev, parse_holdem_hand(row[0])]
             hand_results.append(v)   
-    return hand_results             
+    return sorted(hand_results, reverse=True)
+
+def write_results(fname, hand_results, info = None):
+    #
+    # The raw counts of every hand as NumPy columns: hands (their cards),
+    # trials, wins, ties and the winning rank histogram, in the order of
+    # hand_results, compressed. Loads without parsing any text. info is an
+    # optional JSON friendly dict describing the run, kept as a string.
+    #
+    with open(fname + ".tmp", 'wb') as f:
+        np.savez_compressed(f, info=np.array(json.dumps(info)),
+            hands=np.array([hand[1] for hand in hand_results], dtype=np.int8),
+            trials=np.array([hand[2]["trials"] for hand in hand_results], dtype=np.int64),
+            wins=np.array([hand[2]["wins"] for hand in hand_results], dtype=np.int64),
+            ties=np.array([hand[2]["ties"] for hand in hand_results], dtype=np.int64),
+            ranks=np.array([hand[2]["ranks"] for hand in hand_results], dtype=np.int64))
+    os.replace(fname + ".tmp", fname)
+
+def load_results(fname):
+    #
+    # The columns write_results saved, as a dict of arrays
+    #
+    with np.load(fname) as results:
+        results = dict([(name, results[name]) for name in results.files])
+    results["info"] = json.loads(str(results["info"])) if "info" in results else None
+    return results
+
+def read_results(fname):
+    #
+    # load_results as hand_results, sorted like run_hold_em_sim's
+    #
+    results = load_results(fname)
+    evs = results["wins"] / results["trials"].astype(np.float64)
+    hand_results = []
+    for i in range(len(evs)):
+        counts = {"trials": int(results["trials"][i]), "wins": int(results["wins"][i]), "ties": int(results["ties"][i]),
+            "ranks": [int(count) for count in results["ranks"][i]]}
+        hand_results.append([float(evs[i]), [int(card) for card in results["hands"][i]], counts])
+    return sorted(hand_results, reverse=True)
+
+def merge_results(fnames):
+    #
+    # Add up the partial results written by the shards of one sweep. Returns
+    # the info of the sweep (without the shard) and the merged results,
+    # sorted. Shards from different sweeps, repeated or missing shards are an
+    # error.
+    #
+    info = None
+    shards = []
+    counts = {}
+    for fname in fnames:
+        results = load_results(fname)
+        part = dict(results["info"] or {})
+        if "shard" not in part:
+            raise ValueError("%s isn't a shard's results" % fname)
+        shards.append(part.pop("shard"))
+        if info is None:
+            info = part
+        elif part != info:
+            raise ValueError("%s is from a different sweep" % fname)
+        for i in range(len(results["trials"])):
+            hand = tuple([int(card) for card in results["hands"][i]])
+            merge_counts(counts.setdefault(hand, new_counts()), {"trials": int(results["trials"][i]),
+                "wins": int(results["wins"][i]), "ties": int(results["ties"][i]),
+                "ranks": [int(count) for count in results["ranks"][i]]})
+
+    if info is None:
+        raise ValueError("no results to merge")
+    if sorted(shards) != list(range(1, info["shards"] + 1)):
+        raise ValueError("have shards %s of %d" % (", ".join([str(shard) for shard in sorted(shards)]), info["shards"]))
+    hand_results = []
+    for hand, hand_counts in counts.items():
+        hand_results.append([float(hand_counts["wins"])/float(hand_counts["trials"]), list(hand), hand_counts])
+    return info, sorted(hand_results, reverse=True)
+
+CARD_TEXT = re.compile(RANGE_VALUE + '([dhcs])$')
+
+def parse_card(text):
+    #
+    # Inverse of format_card, e.g. "Ah" or "10d"
+    #
+    match = CARD_TEXT.match(text.strip())
+    if match is None:
+        raise ValueError("bad card: %s" % text)
+    return make_card(parse_value(match.group(1)), match.group(2))
+
+SERVICE_CACHE_SIZE = 10000
+SERVICE_BATCH_MIN = 8
+
+async def serve(address, matrix_file = EQUITY_MATRIX_FILE):
+    #
+    # Equity service. address is host:port for TCP, anything else is a Unix
+    # socket path. Each line sent is a JSON request, answered by one line of
+    # JSON, with the request's "id" copied over so pipelined requests can be
+    # matched up:
+    #
+    #   {"op": "evaluate", "cards": ["Ah", "Kh", ...]}  5 to 7 cards
+    #   {"op": "winners", "hands": [["Ah", ...], ...]}   indexes of the winners
+    #   {"op": "equity", "hero": "AKs", "villains": ["QQ+"], "trials": 10000, "flop": false}
+    #   {"op": "matchup", "hand": "A,Ks", "other": "Q,Q"}
+    #   {"op": "board", "hole": ["Ah", "Kh"], "board": ["Qh", "7h", "2c"], "opponents": 1, "ms": 5}
+    #       board_equity within "ms" milliseconds and/or "samples" deals
+    #
+    # Evaluations that arrive together are scored in one batch_strengths
+    # call. Equity answers are cached, and a query already being worked on is
+    # shared rather than run twice.
+    #
+    loop = asyncio.get_running_loop()
+    pending = []
+    equity_cache = {}
+    in_flight = {}
+
+    def score_pending():
+        batch = pending[:]
+        del pending[:]
+        by_size = {}
+        for cards, future in batch:
+            by_size.setdefault(len(cards), []).append((cards, future))
+        for size, group in by_size.items():
+            try:
+                if len(group) < SERVICE_BATCH_MIN:
+                    strengths = [best_hand_strength(cards) for cards, future in group]
+                else:
+                    strengths = batch_strengths(np.array([cards for cards, future in group], dtype=np.int64))
+            except Exception as err:
+                for cards, future in group:
+                    future.set_exception(err)
+                continue
+            for (cards, future), strength in zip(group, strengths):
+                future.set_result(int(strength))
+
+    async def evaluate(cards):
+        if not 5 <= len(cards) <= 7 or len(set(cards)) != len(cards):
+            raise ValueError("need 5 to 7 different cards")
+        future = loop.create_future()
+        pending.append((cards, future))
+        if len(pending) == 1:
+            loop.call_soon(score_pending)
+        return await future
+
+    async def equity_query(hero, villains, trials, flop_only):
+        key = (hero, tuple(villains), trials, flop_only)
+        if key in equity_cache:
+            return equity_cache[key]
+        if key not in in_flight:
+            in_flight[key] = loop.run_in_executor(None, range_equity, hero, villains, trials, flop_only)
+        try:
+            counts = await asyncio.shield(in_flight[key])
+        finally:
+            in_flight.pop(key, None)
+        result = {"equity": equity(counts), "win": float(counts["wins"] - counts["ties"]) / counts["trials"],
+            "tie": float(counts["ties"]) / counts["trials"], "trials": counts["trials"]}
+        equity_cache[key] = result
+        if len(equity_cache) > SERVICE_CACHE_SIZE:
+            del equity_cache[next(iter(equity_cache))]
+        return result
+
+    async def answer(request):
+        op = request.get("op")
+        if op == "evaluate":
+            strength = await evaluate([parse_card(card) for card in request["cards"]])
+            return {"strength": strength, "rank": format_rank(strength_rank(strength))}
+        elif op == "winners":
+            strengths = await asyncio.gather(*[evaluate([parse_card(card) for card in hand]) for hand in request["hands"]])
+            best = max(strengths)
+            return {"winners": [i for i, strength in enumerate(strengths) if strength == best],
+                "rank": format_rank(strength_rank(best))}
+        elif op == "equity":
+            return await equity_query(request["hero"], list(request["villains"]), int(request.get("trials", 10000)),
+                bool(request.get("flop", False)))
+        elif op == "matchup":
+            win, tie, loss = matchup_equity(request["hand"], request["other"], matrix_file)
+            return {"win": win, "tie": tie, "loss": loss}
+        elif op == "board":
+            budget = request["ms"] / 1000.0 if "ms" in request else None
+            estimate, error, counts = await loop.run_in_executor(None, board_equity,
+                [parse_card(card) for card in request["hole"]], [parse_card(card) for card in request.get("board", [])],
+                int(request.get("opponents", 1)), budget, request.get("samples"))
+            return {"equity": estimate, "error": error, "exact": counts["exact"], "trials": counts["trials"]}
+        raise ValueError("unknown op %s" % op)
+
+    async def reply(line, writer):
+        request = {}
+        try:
+            request = json.loads(line)
+            response = await answer(request)
+        except Exception as err:
+            response = {"error": str(err)}
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        writer.write((json.dumps(response) + "\n").encode())
+
+    async def client(reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(reply(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    #
+    # Warm the tables before taking requests
+    #
+    warm_tables()
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        server = await asyncio.start_server(client, host, int(port))
+    else:
+        server = await asyncio.start_unix_server(client, address)
+    print("serving on %s" % address)
+    async with server:
+        await server.serve_forever()
 
 def usage():
     msg = """
@@ -586,16 +2862,106 @@ Parameters
 ----------
 --hands=[hands] the number of player hands in each run (for holdem)
 --runs=[runs] the number of hands (runs) to play. For holdem, it will run 
-       runs * 169, one for each hand possibility
---game=[game] Which game (holdem, five) to play. Defaults to holdem
+       runs * 169, one for each hand possibility. For omaha it is the total
+       number of deals, shared by every starting hand.
+--game=[game] Which game (holdem, five, omaha) to play. Defaults to holdem
+--hole=[cards] Hole cards per omaha hand, 4 or 5. Defaults to 4. Omaha has
+       too many starting hands to sweep one by one, so every seat of --runs
+       deals counts for its starting hand (up to suits) instead. The CSV is
+       ranked by the low end of each hand's 95%% confidence interval, since
+       most hands are only dealt a few times. Honours --flop, --batch,
+       --workers and --seed.
+-l [file] Graph holdem results from a CSV, a .npz (written next to every CSV,
+       with the raw counts) or a --store file instead of running. A holdem
+       sweep fills its CSV in as starting hands finish, so -l works on one
+       still running too; it is sorted best first once the sweep is done.
 --flop For a flop game, only run through the flop, ignoring turn and river.
        Defaults to false.
-    """ % sys.argv[0]
+--shared For holdem, play every starting hand against the same dealt boards
+       and opponents, skipping the ones it collides with, until each hand
+       has --runs of them. Faster, and the ranking is less noisy. Honours
+       --flop, --batch, --workers and --seed.
+--streets For holdem, score every deal at the flop, turn and river in one
+       run and write a CSV for each. Honours --batch, --workers and --seed.
+--each-size For holdem, deal --hands players once per hand and read off the
+       result at every table size from 2 to --hands players, writing the
+       CSV each size's own run would. Honours --flop, --batch, --workers
+       and --seed.
+--batch=[size] Deal and score this many hands (tables for five) at a time
+       with NumPy instead of one at a time.
+--workers=[workers] Spread the starting hands (the deals for five) over this
+       many processes. 0 uses every core. Defaults to 1.
+--seed=[seed] Seed the random streams so a run can be repeated. Results don't
+       depend on the number of workers.
+--exact For heads up holdem (--hands=2), enumerate every opponent hand and
+       field instead of sampling. --runs is ignored. Quick with --flop, slow
+       for the full field. For five with --hands=1 or 2, count the winning
+       ranks of every possible deal. Beyond 2 hands five has no exact mode.
+--ci=[width] For holdem, keep sampling each starting hand until its 95%%
+       confidence interval is within width either side of its EV, or it is
+       clearly ahead of and behind its neighbours. --runs caps the samples
+       per hand.
+--store=[file] For holdem, keep raw counts in this JSON file across runs.
+       Hands already in it are only topped up to --runs, and -l reads a
+       store when given one (with --hands and --flop to pick the results).
+--resume For holdem, carry on from the checkpoint a killed run left next to
+       its CSV. Progress is checkpointed as hands finish and every minute.
+--profile=[file] Write per stage timers and counters (dealing, evaluation,
+       showdown, tie break depth per rank, hands/sec per starting hand) to
+       this JSON file.
+--cprofile=[file] Run under cProfile and write the stats to this file.
+--equity=[range] Instead of the sweep, print the equity of this hand or range
+       (e.g. "AhKh" or "QQ+, AKs, KQo, 76s-54s") against each --vs range,
+       over --runs deals. Honours --flop, --batch and --seed.
+--vs=[range] An opponent's range for --equity. Give it once per opponent.
+--board=[cards] With --equity of one hand, the known board (e.g. "Qh 7h 2c"),
+       played to the river against --hands - 1 random hands. Stops after
+       --budget or --runs deals, or enumerates exactly heads up when that
+       fits (always on the river), and prints the equity with its 95%% error
+       bound.
+--budget=[milliseconds] Time limit for --board.
+--matrix=[file] Build the heads up equity matrix of every starting hand
+       against every other, --runs deals each, into this file. Honours
+       --batch, --workers and --seed.
+--shard=[i/n] For holdem, run only shard i (1 to n) of the sweep and write
+       its counts to a .npz named after the CSV. Run every shard, anywhere,
+       then "%s merge" the files to get the CSV. Honours --chunks, --exact,
+       --flop, --batch, --workers and --seed; give every shard the same ones.
+--chunks=[chunks] With --shard, split each starting hand's runs into this many
+       pieces to spread over the shards. Defaults to 1.
+--cache=[megabytes] Cache best hand strengths by suit normalized cards, in up
+       to this much memory, for the one at a time holdem paths. Filled up
+       front with every hand that can't be a flush and shared with the
+       workers. Hit rates go in the --profile output, and are printed with -v.
+--serve=[address] Answer evaluation, showdown and equity queries as JSON lines
+       on host:port, or on a Unix socket at any other address, until
+       killed. See serve() for the requests.
+--matchup=[hands] Look up two hands in the equity matrix, e.g. "A,Ks vs Q,Q"
+       or "AKs vs QQ". Reads %s unless --matrix names another.
+
+%s merge [files]
+Merge the .npz files from every --shard of a sweep into its CSV and .npz.
+    """ % (sys.argv[0], sys.argv[0], EQUITY_MATRIX_FILE, sys.argv[0])
     print(msg)
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["merge"]:
+        if len(sys.argv) < 3:
+            usage()
+            exit(1)
+        try:
+            info, hand_results = merge_results(sys.argv[2:])
+        except ValueError as err:
+            print(err)
+            exit(1)
+        fname = info["fname"]
+        write_csv(fname, hand_results)
+        write_results(fname[:-4] + ".npz", hand_results)
+        print("wrote %s and %s" % (fname, fname[:-4] + ".npz"))
+        exit(0)
+
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "g:h:r:fvl:", ["hands=", "runs=", "game=", "flop"])
+        opts, args = getopt.getopt(sys.argv[1:], "g:h:r:fvl:b:w:s:xc:", ["hands=", "runs=", "game=", "flop", "batch=", "workers=", "seed=", "exact", "ci=", "store=", "resume", "profile=", "cprofile=", "equity=", "vs=", "matrix=", "matchup=", "streets", "shared", "serve=", "shard=", "chunks=", "cache=", "hole=", "board=", "budget=", "each-size"])
     except getopt.GetoptError as err:
         # print help information and exit:
         print(err)
@@ -605,9 +2971,32 @@ if __name__ == "__main__":
     runs = None
     hands = None
     game = "holdem"
+    num_hole = 4
     flop_only = False
     verbose = False
     load_file = None
+    batch_size = None
+    workers = 1
+    seed = None
+    exact = False
+    ci = None
+    store_file = None
+    resume = False
+    profile_file = None
+    cprofile_file = None
+    equity_range = None
+    villain_ranges = []
+    board = None
+    budget = None
+    each_size = False
+    matrix_file = None
+    matchup = None
+    streets = False
+    shared = False
+    serve_address = None
+    shard = None
+    num_chunks = 1
+    cache_mb = None
     for o, a in opts:
         if o == "-v":
             verbose = True
@@ -619,43 +3008,282 @@ if __name__ == "__main__":
             game = a
         elif o in ("-f", "--flop"):
             flop_only = True
+        elif o in ("-b", "--batch"):
+            batch_size = int(a)
+        elif o in ("-w", "--workers"):
+            workers = int(a)
+        elif o in ("-s", "--seed"):
+            seed = int(a)
+        elif o in ("-x", "--exact"):
+            exact = True
+        elif o in ("-c", "--ci"):
+            ci = float(a)
+        elif o == "--store":
+            store_file = a
+        elif o == "--resume":
+            resume = True
+        elif o == "--profile":
+            profile_file = a
+        elif o == "--cprofile":
+            cprofile_file = a
+        elif o == "--equity":
+            equity_range = a
+        elif o == "--vs":
+            villain_ranges.append(a)
+        elif o == "--matrix":
+            matrix_file = a
+        elif o == "--matchup":
+            matchup = a
+        elif o == "--streets":
+            streets = True
+        elif o == "--shared":
+            shared = True
+        elif o == "--serve":
+            serve_address = a
+        elif o == "--shard":
+            shard = [int(part) for part in a.split("/")]
+        elif o == "--chunks":
+            num_chunks = int(a)
+        elif o == "--cache":
+            cache_mb = float(a)
+        elif o == "--hole":
+            num_hole = int(a)
+        elif o == "--board":
+            board = a
+        elif o == "--budget":
+            budget = float(a) / 1000.0
+        elif o == "--each-size":
+            each_size = True
         elif o in ("-l"):
             load_file = a
             verbose = True
         else:
             usage()
             assert False, "unhandled option"
-    if not load_file and (not hands or not runs):
+    if equity_range and board is not None:
+        if not (runs or budget):
+            usage()
+            exit(0)
+        try:
+            hero = parse_range(equity_range)
+            if len(hero) != 1:
+                raise ValueError("--board needs one hand, not a range: %s" % equity_range)
+            warm_tables()
+            estimate, error, counts = board_equity(hero[0], [parse_card(card) for card in board.replace(',', ' ').split()],
+                (hands or 2) - 1, budget, runs, batch_size or 10000, seed)
+        except ValueError as err:
+            print(err)
+            exit(1)
+        print("%s on %s vs %d: %.2f%% +- %.2f%% equity, %s %d hands" % (equity_range, board, (hands or 2) - 1,
+            estimate * 100.0, error * 100.0, "enumerated" if counts["exact"] else "sampled", counts["trials"]))
+        exit(0)
+
+    if equity_range:
+        if not runs or not villain_ranges:
+            usage()
+            exit(0)
+        try:
+            counts = range_equity(equity_range, villain_ranges, runs, flop_only, batch_size or 10000, seed)
+        except ValueError as err:
+            print(err)
+            exit(1)
+        print("%s vs %s: %.2f%% equity, won %.2f%% (split %.2f%%) of %d hands" % (equity_range,
+            " vs ".join(villain_ranges), equity(counts) * 100.0, counts["wins"] * 100.0 / counts["trials"],
+            counts["ties"] * 100.0 / counts["trials"], counts["trials"]))
+        exit(0)
+
+    if serve_address:
+        try:
+            asyncio.run(serve(serve_address, matrix_file or EQUITY_MATRIX_FILE))
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+
+    if matchup:
+        try:
+            if len(matchup.split("vs")) != 2:
+                raise ValueError("--matchup needs two hands, e.g. \"A,Ks vs Q,Q\"")
+            hand, other_hand = [part.strip() for part in matchup.split("vs")]
+            win, tie, loss = matchup_equity(hand, other_hand, matrix_file or EQUITY_MATRIX_FILE)
+        except (ValueError, OSError) as err:
+            print(err)
+            exit(1)
+        print("%s vs %s: win %.2f%%, tie %.2f%%, lose %.2f%%" % (hand, other_hand, win * 100.0, tie * 100.0, loss * 100.0))
+        exit(0)
+
+    if matrix_file:
+        if not runs:
+            usage()
+            exit(0)
+        build_equity_matrix(matrix_file, runs, batch_size or 10000, workers, seed)
+        print("wrote %s" % matrix_file)
+        exit(0)
+
+    if not load_file and (not hands or not (runs or exact)):
         usage()
         exit(0)
 
-    if  game not in ('holdem', 'five'):
+    if load_file and load_file.endswith(".json") and not hands:
+        print("-l with a --store file needs --hands to pick the results")
+        usage()
+        exit(1)
+
+    if shard and (game != 'holdem' or len(shard) != 2 or not 1 <= shard[0] <= shard[1] or num_chunks < 1 or ci
+            or store_file or resume or streets or shared or (exact and num_chunks > 1)):
+        print("--shard=i/n needs 1 <= i <= n, and can't be used with --ci, --store, --resume, --streets, --shared"
+            " or --exact with --chunks")
+        usage()
+        exit(1)
+
+    if shared and (game != 'holdem' or not runs or exact or ci or store_file or resume or streets):
+        print("--shared is a sampled holdem sweep, without --exact, --ci, --store, --resume or --streets")
+        usage()
+        exit(1)
+
+    if streets:
+        if game != 'holdem' or not runs or flop_only or exact or ci or store_file or resume or each_size:
+            print("--streets is a sampled holdem sweep, without --flop, --exact, --ci, --store, --resume or --each-size")
+            usage()
+            exit(1)
+        street_results = run_hold_em_each_sim("streets", runs, hands, False, batch_size, workers, seed)
+        for street, field_size in STREETS:
+            fname = "%s_%d_runs_%d_hands%s.csv" % (game, runs, hands, {"flop": "_floponly", "turn": "_turn", "river": ""}[street])
+            write_csv(fname, street_results[street])
+            write_results(fname[:-4] + ".npz", street_results[street])
+            print("wrote %s and %s" % (fname, fname[:-4] + ".npz"))
+        exit(0)
+
+    if each_size:
+        if game != 'holdem' or not runs or hands < 2 or exact or ci or store_file or resume or streets or shared or shard:
+            print("--each-size is a sampled holdem sweep, without --exact, --ci, --store, --resume, --streets, --shared or --shard")
+            usage()
+            exit(1)
+        size_results = run_hold_em_each_sim("sizes", runs, hands, flop_only, batch_size, workers, seed)
+        for num_players in sorted(size_results):
+            fname = "%s_%d_runs_%d_hands%s.csv" % (game, runs, num_players, "_floponly" if flop_only else "")
+            write_csv(fname, size_results[num_players])
+            write_results(fname[:-4] + ".npz", size_results[num_players])
+            print("wrote %s and %s" % (fname, fname[:-4] + ".npz"))
+        exit(0)
+
+    if exact and game == 'holdem' and hands != 2:
+        print("--exact only works heads up (--hands=2)")
+        usage()
+        exit(1)
+    if exact and game == 'five' and hands not in (1, 2):
+        print("--exact for five only works with --hands=1 or 2")
+        usage()
+        exit(1)
+
+    if  game not in ('holdem', 'five', 'omaha'):
         print("Unknown game %s" % game)
         usage()
         exit(1)
 
+    if game == 'omaha' and (not runs or num_hole not in (4, 5) or hands * num_hole + 5 > NUM_CARDS or exact or ci
+            or store_file or resume or load_file):
+        print("omaha is a sampled sweep with --hole=4 or 5, without --exact, --ci, --store, --resume or -l")
+        usage()
+        exit(1)
+
+    if cache_mb:
+        eval_cache = new_eval_cache(int(cache_mb * (1 << 20)))
+        warm_eval_cache(eval_cache)
+
+    if profile_file:
+        stage_stats = new_stats()
+        started = time.perf_counter()
+    if cprofile_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     if game == 'holdem':
         if not load_file:
-            hand_results = run_hold_em_sim(runs, hands, flop_only)
-            fname = "%s_%d_runs_%d_hands%s.csv" % (game, runs, hands, "_floponly" if flop_only else "")
-            with open(fname, 'w') as f:
-                for hand in hand_results:
-                    f.write("\"%s\", %f\n" % (format_holdem_hand_for_graph(hand[1]), hand[0]))
-            print("wrote %s" % fname)
+            if exact:
+                fname = "%s_exact_%d_hands%s.csv" % (game, hands, "_floponly" if flop_only else "")
+            else:
+                fname = "%s_%d_runs_%d_hands%s.csv" % (game, runs, hands, "_floponly" if flop_only else "")
+            if shard:
+                hand_results = run_hold_em_shard(runs, hands, flop_only, shard[0] - 1, shard[1], num_chunks, batch_size,
+                    workers, seed, exact)
+                info = {"fname": fname, "hands": hands, "runs": runs, "flop_only": flop_only, "exact": exact,
+                    "seed": seed, "chunks": num_chunks, "shards": shard[1], "shard": shard[0]}
+                shard_fname = "%s.shard_%d_of_%d.npz" % (fname[:-4], shard[0], shard[1])
+                write_results(shard_fname, hand_results, info)
+                print("wrote %s" % shard_fname)
+            else:
+                store = load_store(store_file) if store_file else None
+                if shared:
+                    hand_results = run_shared_sim(runs, hands, flop_only, batch_size, workers, seed)
+                else:
+                    #
+                    # Fill the CSV in as hands finish, so it can be watched
+                    # (or read with -l) while the sweep runs, then sort it
+                    #
+                    hand_results = []
+                    with open(fname, 'w') as f:
+                        for i, test_hand, counts, finished in iter_hold_em_sim(runs, hands, flop_only, batch_size,
+                                workers, seed, exact, ci, store, fname + ".checkpoint", resume):
+                            if finished:
+                                hand_results.append([float(counts["wins"])/float(counts["trials"]), test_hand, counts])
+                                f.write(csv_row(hand_results[-1]))
+                                f.flush()
+                    hand_results = sorted(hand_results, reverse=True)
+                if store_file:
+                    save_store(store_file, store)
+                write_csv(fname, hand_results)
+                write_results(fname[:-4] + ".npz", hand_results)
+                print("wrote %s and %s" % (fname, fname[:-4] + ".npz"))
+        elif load_file.endswith(".json"):
+            hand_results = read_store(load_file, hands, flop_only, exact)
+        elif load_file.endswith(".npz"):
+            hand_results = read_results(load_file)
         else:
             hand_results = read_csv(load_file) 
 
-        if verbose:
+        if verbose and not shard and hand_results:
             #
-            # Show graph. Threshold will be top 25% of hands. There are 169 possible hands.
+            # Show graph. Threshold will be top 25% of hands. There are 169 possible
+            # hands, but a partial file or store can hold fewer.
             #
             print(len(hand_results))
-            threshold = hand_results[round(169 * .25)][0]
+            def top(fraction):
+                return hand_results[min(round(len(hand_results) * fraction), len(hand_results) - 1)][0]
+            threshold = top(.25)
 
             # Determine EV of top 10% and top 20% hands
-            top_10_ev = hand_results[round(169 * .1)][0]
-            top_20_ev = hand_results[round(169 * .2)][0]
+            top_10_ev = top(.1)
+            top_20_ev = top(.2)
 
             graph(split_results(hand_results, threshold), threshold, top_10_ev, top_20_ev)
+    elif game == 'omaha':
+        fname = "%s%d_%d_runs_%d_hands%s.csv" % (game, num_hole, runs, hands, "_floponly" if flop_only else "")
+        hand_results = run_omaha_sim(runs, hands, num_hole, flop_only, batch_size, workers, seed)
+        write_csv(fname, hand_results)
+        write_results(fname[:-4] + ".npz", hand_results)
+        print("wrote %s and %s (%d starting hands)" % (fname, fname[:-4] + ".npz", len(hand_results)))
     else:
-        run_five_card_sim(runs, hands)
+        if exact:
+            fname = "%s_exact_%d_hands.json" % (game, hands)
+            winning_rank, runs = exact_five_card(hands)
+        else:
+            fname = "%s_%d_runs_%d_hands.json" % (game, runs, hands)
+            winning_rank = run_five_card_sim(runs, hands, batch_size, workers, seed)
+        write_json(fname, {"hands": hands, "trials": runs, "exact": exact,
+            "ranks": dict([(format_rank(i), winning_rank[i]) for i in range(len(winning_rank))])})
+        print("wrote %s" % fname)
+
+    if cprofile_file:
+        profiler.disable()
+        profiler.dump_stats(cprofile_file)
+        print("wrote %s" % cprofile_file)
+    if eval_cache is not None and verbose:
+        print("evaluation cache (this process, see --profile for workers): %s" % eval_cache_stats())
+    if profile_file:
+        if eval_cache is not None:
+            stage_stats["eval_cache"] = eval_cache_stats()
+        seconds = time.perf_counter() - started
+        stage_stats["seconds"] = seconds
+        stage_stats["hands_per_sec"] = stage_stats["counters"]["hands"] / seconds if seconds else 0.0
+        write_json(profile_file, stage_stats)
+        print("wrote %s" % profile_file)